@@ -187,6 +187,7 @@ class Disease(object):
         self.quarantined = {}
         self.quarantine_start_day = {}
         self.quarantine_end_day = {}
+        self.pending_attendance = [] # (person,present) changes not yet passed to the registrar
         self.recorded_info = {}
         self.completed_infections = 0
         self.average_transmissions = 0
@@ -205,12 +206,12 @@ class Disease(object):
             self.quarantined[person] = True
             self.quarantine_end_day[person] = self.quarantine_days + self.day
             self.quarantine_start_day[person] = self.day
-            self.registrar.register_departure(person)
+            self.pending_attendance.append((person,False))
             self._record_state_change(person,'quarantined')
             return
         elif etype == 'dequarantined':
             del self.quarantined[person]
-            self.registrar.register_return(person)
+            self.pending_attendance.append((person,True))
             self._record_state_change(person,'dequarantined')
             return
         elif etype == 'removed':
@@ -292,6 +293,20 @@ class Disease(object):
             likelihood *= 0.8
         return probtools.random_event(1-(1-likelihood)**contact_strength)
 
+    def _apply_attendance(self):
+        # Quarantine changes reach the registrar together before the day's transmissions,
+        # as runs of departures and returns in the order they happened
+        run = []
+        for index,(person,present) in enumerate(self.pending_attendance):
+            run.append(person)
+            if index + 1 == len(self.pending_attendance) or self.pending_attendance[index+1][1] != present:
+                if present:
+                    self.registrar.register_returns(run)
+                else:
+                    self.registrar.register_departures(run)
+                run = []
+        self.pending_attendance = []
+
     def execute_main_step(self):
         self.day += 1
         self.registrar.update_query_system()
@@ -330,31 +345,31 @@ class Disease(object):
             self.event('removed',person,message='Removed from infection')
 
         if self.contact_tracing:
-            for person in self.contact_tracing_queue:
-                self.contact_traces_performed_today += 1
-                first_trace_day = self.day - self.contact_tracing_days
-                post_trace_day = self.day
-                if person in self.quarantined:
-                    post_trace_day = min(post_trace_day,self.quarantine_start_day[person]+1)
-                for trace_day in range(first_trace_day,post_trace_day):
-                    identified_contacts = self.registrar.query_contacts(person,trace_day-self.day)
-                    for found_individual in identified_contacts:
-                        if found_individual in self.all_individuals and found_individual not in self.quarantined:
-                            actions = probtools.random_threshold({'test' : self.contact_tracing_testing_rate, 'quarantine' : self.contact_tracing_quarantine_rate})
-                            if 'test' in actions:
-                                self.testing_queue.add(found_individual,abort_if=self.quarantined)
-                            if 'quarantine' in actions and found_individual not in self.quarantined:
-                                self.event('quarantined',found_individual,message='Quarantined on Contact Trace')
-
-
+            traced = list(self.contact_tracing_queue)
+            self.contact_traces_performed_today += len(traced)
+            # Quarantine stops the trace the day after it began; each day is asked for everyone at once
+            for trace_day in range(self.day - self.contact_tracing_days,self.day):
+                tracing = [person for person in traced if person not in self.quarantined or trace_day <= self.quarantine_start_day[person]]
+                offsets,contact_ids,strengths = self.registrar.query_contacts_many(tracing,trace_day-self.day)
+                for found_individual in contact_ids:
+                    if found_individual in self.all_individuals and found_individual not in self.quarantined:
+                        actions = probtools.random_threshold({'test' : self.contact_tracing_testing_rate, 'quarantine' : self.contact_tracing_quarantine_rate})
+                        if 'test' in actions:
+                            self.testing_queue.add(found_individual,abort_if=self.quarantined)
+                        if 'quarantine' in actions and found_individual not in self.quarantined:
+                            self.event('quarantined',found_individual,message='Quarantined on Contact Trace')
+
+
+        self._apply_attendance()
         to_be_infected = {}
-        for person in self.infected:
-            if person not in self.quarantined:
-                contact_information = self.registrar.query_transmit(person)
-                for potential_infected in contact_information:
-                    if potential_infected in self.susceptible and potential_infected not in self.quarantined and potential_infected not in to_be_infected and self.transmission_success(person,contact_information[potential_infected]):
-                        to_be_infected[potential_infected] = person
-                        self.infection_transmissions[person] += 1
+        transmitting = [person for person in self.infected if person not in self.quarantined]
+        offsets,contact_ids,strengths = self.registrar.query_transmit_many(transmitting)
+        for index,person in enumerate(transmitting):
+            for position in range(offsets[index],offsets[index+1]):
+                potential_infected = contact_ids[position]
+                if potential_infected in self.susceptible and potential_infected not in self.quarantined and potential_infected not in to_be_infected and self.transmission_success(person,strengths[position]):
+                    to_be_infected[potential_infected] = person
+                    self.infection_transmissions[person] += 1
 
         for person in to_be_infected:
             self.event('infected',person,infected_by=to_be_infected[person],message='Infection by transmission')
@@ -381,6 +396,7 @@ class Disease(object):
             self.execute_main_step()
             print('%04i-%03i  S %05i  I %05i  R %05i  Q %05i  CT %05i  TP %05i  R %5.3f' % (number+1,index+1,len(self.susceptible),len(self.infected),len(self.removed),len(self.quarantined),self.contact_traces_performed_today,self.tests_performed_today,self.average_transmissions))
             self.recorder.record(self.recorded_info)
+        self.registrar.end_run()
     def multiple_runs(self,number):
         output_every = max(int(number / 4),1)
         for runno in range(number):
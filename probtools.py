@@ -65,6 +65,8 @@ class FastSubsets(object):
     def draw(self,k):
         index = random.randrange(0,self.options[k])
         return self.selections[k][index]
+    def draw_many(self,k,count):
+        return random.choices(self.selections[k],k=count)
     def _all_symmetric_subsets(self,k,n):
         if k == 0:
             return [[]]
@@ -227,8 +229,8 @@ class Poisson(object):
             mypdf.append(value-last)
             last = value
         return mypdf
-    def _draw_from_CDF(self,CDF):
-        uniform = random.random()
+    def _draw_from_CDF(self,CDF,rng=random):
+        uniform = rng.random()
         lower = -1
         lcuml =  0
         upper = len(CDF) - 1
@@ -245,7 +247,8 @@ class Poisson(object):
                 upper = middle
                 rcuml = mcuml
         return upper
-    def draw(self,intensity):
+    def draw(self,intensity,rng=random):
+        # rng is anything with random(), such as a seeded random.Random
         while intensity > self.endI:
             self.endI *= 2
             result = self._createCDF(self.endI)
@@ -260,13 +263,13 @@ class Poisson(object):
             while intense_remaining > 2*atI:
                 atI *= 2
                 index += 1
-            drawn += self._draw_from_CDF(self.CDFlist[index][1]) + self.CDFlist[index][0]
+            drawn += self._draw_from_CDF(self.CDFlist[index][1],rng) + self.CDFlist[index][0]
             intense_remaining -= atI
         repeats = 1 + int(intense_remaining/2)
         ifrac = intense_remaining / repeats
         for rounds in range(repeats):
             incremental_term = math.exp(-ifrac)
-            dice = random.random()
+            dice = rng.random()
             cumulative = incremental_term
             newdraw = 0
             while cumulative < dice:
@@ -787,6 +790,37 @@ class CustomDistribution(object):
             else:
                 top = midpt
         return top
+    def draw_many(self,count):
+        # count independent draws at once, bisecting the cumulative totals
+        return random.choices(range(self.length),cum_weights=[self.cumulative[index] for index in range(self.length)],k=count)
+
+class AliasTable(object):
+    # Walker's alias method: draw() returns index with probability mylist[index]/total in constant time
+    def __init__(self,mylist):
+        self.length = len(mylist)
+        self.total = sum(mylist)
+        self.probability = [1.0] * self.length
+        self.alias = list(range(self.length))
+        if self.total <= 0:
+            return
+        scaled = [value * self.length / self.total for value in mylist]
+        small = [index for index,value in enumerate(scaled) if value < 1]
+        large = [index for index,value in enumerate(scaled) if value >= 1]
+        while len(small) > 0 and len(large) > 0:
+            lesser = small.pop()
+            greater = large.pop()
+            self.probability[lesser] = scaled[lesser]
+            self.alias[lesser] = greater
+            scaled[greater] += scaled[lesser] - 1
+            if scaled[greater] < 1:
+                small.append(greater)
+            else:
+                large.append(greater)
+    def draw(self):
+        index = random.randrange(self.length)
+        if random.random() < self.probability[index]:
+            return index
+        return self.alias[index]
 
 
 class Histogram(object):
@@ -853,23 +887,22 @@ class Histogram(object):
         return chosen
 
 
+def deal(count,sizes):
+    # Bin of each of count items dealt into bins of the given sizes: the items take a
+    # uniformly random set of the sum(sizes) slots, so no bin overfills
+    slots = [index for index,size in enumerate(sizes) for repeat in range(size)]
+    return random.sample(slots,count)
+
 def subdivide(mylist,target_size):
     listsize = len(mylist)
     if target_size >= listsize:
         return [copy.deepcopy(mylist)]
-    histogram = [target_size] * int(1 + len(mylist)/target_size)
-    chooser = Histogram(histogram)
     result = {}
-    for index,item in enumerate(mylist):
-        groupin = chooser.draw(1,False)
+    for item,groupin in zip(mylist,deal(listsize,[target_size] * int(1 + listsize/target_size))):
         if groupin not in result:
             result[groupin] = []
         result[groupin].append(item)
-    list_result = []
-    for key in result:
-        group = result[key]
-        list_result.append(group)
-    return list_result
+    return list(result.values())
 
 def ordered_subdivide(mylist,target_size):
     listsize = len(mylist)
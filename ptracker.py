@@ -15,6 +15,10 @@
 
 
 import random
+import array
+import bisect
+import zlib
+import hashlib
 import probtools
 import universal
 
@@ -41,32 +45,271 @@ def dictionary_sum_copy(dict1,dict2):
                 result[key] += value
     return result
 
-class PersonTracker(object):
+MASK64 = (1 << 64) - 1
+
+def stream_key(seed,*key):
+    # A 64-bit key that depends only on seed and key, the same in every process
+    return int.from_bytes(hashlib.blake2b(':'.join(str(part) for part in (seed,) + key).encode(),digest_size=8).digest(),'little')
+
+def mix64(value):
+    # The splitmix64 finalizer: a bijection of 64-bit integers that scrambles every bit
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+class KeyedStream(object):
+    # A splitmix64 generator started from (key,subkey): a context-day hashes its key once
+    # and each person's stream is then just a subkey, with no seeding, so the numbers are
+    # the same in every process and for any query order. random(), randrange() and
+    # choices() draw as random.Random's do
+    def __init__(self,key,subkey=0):
+        # Multiplying by an odd constant is a bijection, so every subkey starts apart
+        self.state = mix64(key ^ ((subkey * 0x9E3779B97F4A7C15) & MASK64))
+    def random(self):
+        self.state = state = (self.state + 0x9E3779B97F4A7C15) & MASK64
+        state = ((state ^ (state >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        state = ((state ^ (state >> 27)) * 0x94D049BB133111EB) & MASK64
+        return ((state ^ (state >> 31)) >> 11) * (1.0 / 9007199254740992.0)
+    def randrange(self,stop):
+        return int(self.random() * stop)
+    def choices(self,population,cum_weights=None,k=1):
+        random = self.random
+        if cum_weights is None:
+            count = len(population)
+            return [population[int(random() * count)] for index in range(k)]
+        total = cum_weights[-1]
+        last = len(population) - 1
+        return [population[bisect.bisect(cum_weights,random() * total,0,last)] for index in range(k)]
+
+def contact_rows(persons,answer):
+    # Packs the contacts of each of persons as compressed rows: those of persons[index]
+    # are ids[offsets[index]:offsets[index+1]] with their strengths alongside.
+    # answer(person,into) adds person's contacts to into, one scratch ContactAccumulator
+    # reset for each person; a person listed again gets a copy of their first row
+    offsets = array.array('l',[0])
+    ids = array.array('l')
+    strengths = array.array('d')
+    scratch = ContactAccumulator()
+    rows = {} # person -> where their first row starts and ends
+    for person in persons:
+        if person in rows:
+            start,end = rows[person]
+            ids.extend(ids[start:end])
+            strengths.extend(strengths[start:end])
+        else:
+            answer(person,scratch.reset())
+            rows[person] = (len(ids),len(ids) + len(scratch))
+            ids.extend(scratch.ids)
+            strengths.extend(scratch.counts)
+        offsets.append(len(ids))
+    return offsets,ids,strengths
+
+class ContactAccumulator(object):
+    # Collects contact counts from any number of contexts into parallel id/count
+    # lists; positions is the scratch index from id to list slot. Reading it
+    # back works like a read-only dictionary, and reset() clears it for reuse.
     def __init__(self):
-        self.ordered_people = {}
-        self.person_positions = {}
-        self.divider = 0 # Where 'On' Starts; strictly below this is off
-        self.divider_memory = 0
+        self.ids = []
+        self.counts = []
+        self.positions = {}
+    def reset(self):
+        self.ids.clear()
+        self.counts.clear()
+        self.positions.clear()
+        return self
+    def add(self,person,count=1):
+        position = self.positions.get(person)
+        if position is None:
+            self.positions[person] = len(self.ids)
+            self.ids.append(person)
+            self.counts.append(count)
+        else:
+            self.counts[position] += count
+    def merge(self,contacts):
+        add = self.add
+        for person,count in contacts.items():
+            add(person,count)
+        return self
+    def items(self):
+        return zip(self.ids,self.counts)
+    def keys(self):
+        return iter(self.ids)
+    def values(self):
+        return iter(self.counts)
+    def get(self,person,default=None):
+        position = self.positions.get(person)
+        if position is None:
+            return default
+        return self.counts[position]
+    def __getitem__(self,person):
+        return self.counts[self.positions[person]]
+    def __contains__(self,person):
+        return person in self.positions
+    def __iter__(self):
+        return iter(self.ids)
+    def __len__(self):
+        return len(self.ids)
+
+class Membership(object):
+    # The people a tracker draws from, each drawn in proportion to their weight (their
+    # multiplicity): the people are listed once, with the weights that are not 1 kept
+    # aside. Contexts with the same people share one Membership, which is fixed once
+    # generation is over except for the attendance journal: the latest state of each
+    # person whose attendance changed, numbered so each tracker can catch up on what it missed
+    def __init__(self):
+        self.people = []
+        self.positions = {} # person -> index in people
+        self.weights = {} # Only weights other than 1
         self.total = 0
+        self.heaviest = 1
+        self.cumulative = None # Running totals of the weights, built by the first weighted draw
+        self.states = {}
+        self.sequence = 0
+        self.holders = 0 # Context sides drawing on it; any change is made on a copy while shared
+    def total_length(self):
+        return self.total
+    def weight(self,person):
+        if person not in self.positions:
+            return 0
+        return self.weights.get(person,1)
+    def add(self,personobj,multiplicity=1):
+        if isinstance(personobj,dict):
+            # Weighted membership (person -> multiplicity)
+            items = personobj.items()
+        elif type(personobj) == list:
+            items = [(person,1) for person in personobj]
+        else:
+            items = [(personobj,1)]
+        people = self.people
+        positions = self.positions
+        weights = self.weights
+        for person,weight in items:
+            weight *= multiplicity
+            self.total += weight
+            if person in positions:
+                weight += weights.get(person,1)
+            else:
+                positions[person] = len(people)
+                people.append(person)
+            if weight != 1:
+                weights[person] = weight
+                if weight > self.heaviest:
+                    self.heaviest = weight
+            elif person in weights:
+                del weights[person]
+        self.cumulative = None
+    def draw(self,count,rng=random):
+        # count independent draws by weight
+        if len(self.weights) == 0:
+            return rng.choices(self.people,k=count)
+        if self.cumulative is None:
+            weights = self.weights
+            running = 0
+            self.cumulative = []
+            for person in self.people:
+                running += weights.get(person,1)
+                self.cumulative.append(running)
+        return rng.choices(self.people,cum_weights=self.cumulative,k=count)
+    def same_people(self,other):
+        return self.people == other.people and self.weights == other.weights
+    def copy(self):
+        other = Membership()
+        other.people = list(self.people)
+        other.positions = dict(self.positions)
+        other.weights = dict(self.weights)
+        other.total = self.total
+        other.heaviest = self.heaviest
+        other.states = dict(self.states)
+        other.sequence = self.sequence
+        return other
+    def record(self,person,state):
+        if person not in self.positions:
+            return False
+        self.sequence += 1
+        self.states[person] = (self.sequence,state)
+        return True
+    def record_many(self,persons,state):
+        # One journal step for a whole group; trackers catch up on it in one pass
+        self.sequence += 1
+        for person in persons:
+            if person in self.positions:
+                self.states[person] = (self.sequence,state)
+
+class PersonTracker(object):
+    # People are on or off, and divider is the weight of those off. Two ways to keep
+    # them: the partition moves off people below the boundary so draws come straight from
+    # the on range, while thinning only lists off people in excluded and rejects them
+    # when drawn, which is cheaper while few are off. Each tracker picks one per day.
+    def __init__(self,membership=None):
+        if membership is None:
+            membership = Membership()
+        self.membership = membership
+        self.ordered_people = None # Private copy of the people, made on the first move
+        self.person_positions = {} # Only people moved away from their membership position
+        self.boundary = 0 # Where 'On' Starts in the partition; strictly below this is off
+        self.boundary_memory = 0
+        self.divider = 0 # Weight of the people that are off
+        self.divider_memory = 0
+        self.total = membership.total_length()
         self.queue = {}
         self.active = True
         self.switch_to = 0
-        self.addition_tasks = {}
+        self.applied = 0 # Last membership journal entry applied
+        self.thinning = True
+        self.excluded = {} # Off people, while thinning
+        self.touched = [] # People touched since save(), while thinning
     def total_length(self):
         return self.total
     def active_length(self):
         return self.total - self.divider
     def weight(self,person):
-        if person not in self.person_positions:
-            return 0
-        return len(self.person_positions[person])
+        return self.membership.weight(person)
+    def people(self):
+        if self.ordered_people is None:
+            return self.membership.people
+        return self.ordered_people
+    def _position(self,person):
+        if person in self.person_positions:
+            return self.person_positions[person]
+        return self.membership.positions.get(person)
     def activate(self):
         if self.active is False:
             self.restore()
             self.active = True
-            for person in self.queue:
-                self.set_state(person,self.queue[person])
-            self.queue = {}
+        self.catch_up()
+        self.set_states(self.queue)
+        self.queue = {}
+        self._choose_mode()
+    def _choose_mode(self):
+        # Thinning until a quarter of the weight is off, and back once it is an eighth
+        if self.thinning and 4 * self.divider > self.total:
+            off = []
+            on = []
+            for person in self.membership.people:
+                if person in self.excluded:
+                    off.append(person)
+                else:
+                    on.append(person)
+            self.thinning = False
+            self.excluded = {}
+            self._arrange(off,on)
+        elif not self.thinning and 8 * self.divider <= self.total:
+            self.excluded = dict.fromkeys(self.people()[:self.boundary],True)
+            self.thinning = True
+            self.ordered_people = None
+            self.person_positions = {}
+            self.boundary = 0
+    def catch_up(self):
+        # Applies attendance changes recorded on the shared membership since the last call
+        membership = self.membership
+        if self.applied == membership.sequence:
+            return
+        changes = {}
+        for person,(sequence,state) in membership.states.items():
+            if sequence > self.applied:
+                changes[person] = state
+        self.set_states(changes)
+        self.applied = membership.sequence
     def deactivate(self,switch_to = 0):
         if self.active is True:
             self.save()
@@ -76,72 +319,141 @@ class PersonTracker(object):
         # Returns a random person in the on state, weighted by their multiplicity in the list
         if self.divider == self.total:
             return None
-        index = random.randrange(self.divider,self.total)
-        return self.ordered_people[index]
+        return self.sample(1)[0]
+    def _draw_range(self,start,count):
+        # count positions of the partition from start on, drawn by weight: uniform positions,
+        # each kept with probability weight/heaviest when the membership is weighted
+        ordered_people = self.ordered_people
+        span = range(start,len(ordered_people))
+        weights = self.membership.weights
+        if len(weights) == 0:
+            return random.choices(span,k=count)
+        heaviest = self.membership.heaviest
+        drawn = []
+        while len(drawn) < count:
+            for index in random.choices(span,k=count-len(drawn)):
+                weight = weights.get(ordered_people[index],1)
+                if weight == heaviest or random.random() * heaviest < weight:
+                    drawn.append(index)
+        return drawn
+    def sample(self,count):
+        # Returns count independent draws from the people in the on state, all at once
+        if self.divider == self.total or count <= 0:
+            return []
+        if self.thinning:
+            membership = self.membership
+            excluded = self.excluded
+            if 4 * self.active_length() < self.total:
+                on = [person for person in membership.people if person not in excluded]
+                if len(membership.weights) == 0:
+                    return random.choices(on,k=count)
+                return random.choices(on,weights=[membership.weights.get(person,1) for person in on],k=count)
+            drawn = []
+            while len(drawn) < count:
+                drawn.extend(person for person in membership.draw(count-len(drawn)) if person not in excluded)
+            return drawn
+        ordered_people = self.ordered_people
+        return [ordered_people[index] for index in self._draw_range(self.boundary,count)]
+    def proposal_length(self):
+        # The weight thin() spreads its proposals over: everyone on when the day began,
+        # or everyone while thinning
+        if self.thinning:
+            return self.total
+        if self.active:
+            return self.total - self.divider
+        return self.total - self.divider_memory
+    def thin(self,count):
+        # count proposals over proposal_length(), keeping those still on; this is
+        # sample() on a Poisson count scaled by active_length()/proposal_length()
+        if self.divider == self.total or count <= 0:
+            return []
+        if self.thinning:
+            excluded = self.excluded
+            return [person for person in self.membership.draw(count) if person not in excluded]
+        ordered_people = self.ordered_people
+        start = self.boundary if self.active else self.boundary_memory
+        return [ordered_people[index] for index in self._draw_range(start,count) if index >= self.boundary]
+    def day_snapshot(self,fresh=False):
+        # While deactivated, [0,boundary_memory) were off when the day began and
+        # [boundary_memory,boundary) have been touched since; fresh forgets the touches
+        if self.active:
+            start,start_weight = self.boundary,self.divider
+        else:
+            start,start_weight = self.boundary_memory,self.divider_memory
+        end,end_weight = (start,start_weight) if fresh else (self.boundary,self.divider)
+        if self.thinning:
+            touched = set(self.touched) if not self.active else set()
+            off = set(person for person in self.excluded if person not in touched)
+            if fresh:
+                done = set()
+            elif self.divider == self.total: # Settled: everyone left counts as done
+                done = set(person for person in self.membership.positions if person not in off)
+            else:
+                done = touched
+            return {'off' : off, 'done' : done, 'available' : self.total - end_weight}
+        ordered_people = self.ordered_people
+        off = set(ordered_people[:start])
+        done = set(ordered_people[start:end])
+        return {'off' : off, 'done' : done, 'available' : self.total - end_weight}
+    def settle(self):
+        # Switches every remaining person off until the next activate()
+        if not self.active:
+            self.divider = self.total
+            if not self.thinning:
+                self.boundary = len(self.ordered_people)
     def save(self):
         self.divider_memory = self.divider
+        self.boundary_memory = self.boundary
+        self.touched = []
     def restore(self):
         self.divider = self.divider_memory
+        self.boundary = self.boundary_memory
+        for person in self.touched:
+            if person in self.excluded:
+                del self.excluded[person]
+        self.touched = []
     def add(self,personobj,*remainder,multiplicity=1):
         # add always inserts new people in the "on" state
-        if type(personobj) == list:
-            personlist = personobj
-            isdict = False
-            if multiplicity == 1:
-                for index,person in enumerate(personobj):
-                    self.ordered_people[self.total+index] = person
-                    if person not in self.person_positions:
-                        self.person_positions[person] = {}
-                    self.person_positions[person][self.total+index] = True
-                self.total += len(personobj)
-                return
-        elif type(personobj) == dict:
-            personlist = personobj
-            isdict = True
-        else:
-            personlist = [personobj]
-            isdict = False
-        for person in personlist:
-            mymult = multiplicity
-            if isdict:
-                mymult *= personlist[person]
-            if person not in self.person_positions:
-                self.person_positions[person] = {}
-            for slots in range(mymult):
-                self.ordered_people[self.total] = person
-                self.person_positions[person][self.total] = True
-                self.total += 1
+        self.membership.add(personobj,multiplicity)
+        self.grow()
+    def grow(self):
+        # Takes in people added to the membership since, as by add()
+        if self.ordered_people is not None:
+            self.ordered_people.extend(self.membership.people[len(self.ordered_people):])
+        self.total = self.membership.total_length()
     def _move_to(self,person,new_position):
-        newpositions = {}
-        new_begin = new_position
-        new_end = new_begin + len(self.person_positions[person])
-        occupy_target = new_position
-        for seat_no in self.person_positions[person]:
-            if seat_no >= new_begin and seat_no < new_end:
-                # Do nothing; it's already in a spot that you want
-                newpositions[seat_no] = True
-            else:
-                while self.ordered_people[occupy_target] == person:
-                    occupy_target += 1
-                current_occupant = self.ordered_people[occupy_target]
-                # At this point we have seat_no which must be vacated and
-                # occupy_target which is the first desired seat not already occupied
-                del self.person_positions[current_occupant][occupy_target]
-                self.person_positions[current_occupant][seat_no] = True
-                newpositions[occupy_target] = True
-                self.ordered_people[occupy_target] = person
-                self.ordered_people[seat_no] = current_occupant
-        self.person_positions[person] = newpositions
+        # Swaps person with whoever holds new_position
+        if self.ordered_people is None:
+            self.ordered_people = list(self.membership.people)
+        ordered_people = self.ordered_people
+        position = self._position(person)
+        occupant = ordered_people[new_position]
+        ordered_people[position] = occupant
+        ordered_people[new_position] = person
+        self.person_positions[occupant] = position
+        self.person_positions[person] = new_position
+    def _arrange(self,off,on):
+        # Lays the partition out afresh: off people first, then on people
+        self.boundary = len(off)
+        weights = self.membership.weights
+        self.divider = sum(weights.get(person,1) for person in off) if len(weights) > 0 else len(off)
+        off.extend(on)
+        self.ordered_people = off
+        positions = self.membership.positions
+        self.person_positions = {person : index for index,person in enumerate(off) if positions[person] != index}
     def get_state(self,person):
-        if person not in self.person_positions:
-            return -1
-        for position in self.person_positions[person]:
-            if position >= self.divider:
-                return 1
-            else:
+        if self.thinning:
+            if person not in self.membership.positions:
+                return -1
+            if person in self.excluded or self.divider == self.total:
                 return 0
+            return 1
+        position = self._position(person)
+        if position is None:
+            return -1
+        return 1 if position >= self.boundary else 0
     def set_state(self,person,state,require_active=True):
-        if person not in self.person_positions:
+        if person not in self.membership.positions:
             return False
         if self.active is False and require_active is True:
             self.queue[person] = state
@@ -149,143 +461,349 @@ class PersonTracker(object):
         mystate = self.get_state(person)
         if mystate == state:
             return
-        tomove = len(self.person_positions[person])
+        weight = self.membership.weight(person)
+        if self.thinning:
+            if state == 0:
+                self.excluded[person] = True
+                self.divider += weight
+                if not self.active:
+                    self.touched.append(person)
+            else:
+                del self.excluded[person]
+                self.divider -= weight
+            return
         if state == 0:
-            self._move_to(person,self.divider)
-            self.divider += tomove
+            self._move_to(person,self.boundary)
+            self.boundary += 1
+            self.divider += weight
+            return
+        self.boundary -= 1
+        self._move_to(person,self.boundary)
+        self.divider -= weight
+    def set_states(self,changes):
+        # Applies many state changes at once: a handful are moved one by one, but
+        # past a point a single stable pass over the people is cheaper
+        people = self.people()
+        if self.thinning or 8 * len(changes) < len(people):
+            for person,state in changes.items():
+                self.set_state(person,state,False)
             return
-        new_divider = self.divider - tomove
-        self._move_to(person,new_divider)
-        self.divider = new_divider
+        off = []
+        on = []
+        for index,person in enumerate(people):
+            state = changes.get(person)
+            if state is None:
+                state = 1 if index >= self.boundary else 0
+            if state == 1:
+                on.append(person)
+            else:
+                off.append(person)
+        self._arrange(off,on)
     def touch(self,person):
         if not self.active:
             self.set_state(person,self.switch_to,False)
 
 class EasyTracker(object):
-    def __init__(self):
-        self.absenteelist = {}
+    # Absences are kept per person as sorted [start,end) day intervals, with end None
+    # while the absence is ongoing; days further back than the horizon read as present
+    def __init__(self,horizon=7):
+        self.intervals = {}
         self.day = 0
-        self.absenteelist[self.day] = {}
+        self.horizon = horizon
     def update(self):
         self.day += 1
-        self.absenteelist[self.day] = {}
-        if self.day-1 in self.absenteelist:
-            for person in self.absenteelist[self.day-1]:
-                self.absenteelist[self.day][person] = True
-        if self.day - 7 in self.absenteelist:
-            del self.absenteelist[self.day-7]
+        if self.day % self.horizon == 0:
+            self._forget(self.day - self.horizon)
+    def _forget(self,before):
+        # Drops intervals that ended before the retention horizon
+        emptied = []
+        for person,spans in self.intervals.items():
+            while len(spans) > 0 and spans[0][1] is not None and spans[0][1] <= before:
+                del spans[0]
+            if len(spans) == 0:
+                emptied.append(person)
+        for person in emptied:
+            del self.intervals[person]
     def absent(self,person):
-        self.absenteelist[self.day][person] = True
+        if person not in self.intervals:
+            self.intervals[person] = [[self.day,None]]
+            return
+        last = self.intervals[person][-1]
+        if last[1] is None:
+            return
+        if last[1] == self.day: # Returned earlier today; the absence just continues
+            last[1] = None
+        else:
+            self.intervals[person].append([self.day,None])
     def present(self,person):
-        if person in self.absenteelist[self.day]:
-            del self.absenteelist[self.day][person]
+        if person not in self.intervals:
+            return
+        spans = self.intervals[person]
+        if spans[-1][1] is not None:
+            return
+        if spans[-1][0] == self.day:
+            del spans[-1]
+            if len(spans) == 0:
+                del self.intervals[person]
+        else:
+            spans[-1][1] = self.day
+    def absentees(self,daydiff=0):
+        return [person for person in self.intervals if self.poll_absent(person,daydiff)]
     def poll_absent(self,person,daydiff=0):
-        if self.day - daydiff not in self.absenteelist:
+        if daydiff < 0 or daydiff >= self.horizon or person not in self.intervals:
             return False
-        if person in self.absenteelist[self.day-daydiff]:
-            return True
+        day = self.day - daydiff
+        for start,end in reversed(self.intervals[person]):
+            if start <= day:
+                return end is None or day < end
         return False
 
+class Attendance(object):
+    # Who is away, kept once for CompoundContact and the backends built from it: the
+    # roster dates each change, and the absent slots of each distinct membership give the
+    # distancing factor of the contexts drawing on it. The sparse and permanent layers
+    # keep rosters of their own and are told of each change
+    def __init__(self,retention_days=7):
+        self.retention_days = retention_days
+        self.roster = EasyTracker(retention_days)
+        self.memberships = []
+        self.membership_offsets = array.array('l',[0])
+        self.membership_ids = array.array('l')
+        self.layers = []
+        self.absentees = {}
+        self.absent_slots = [] # Slots of people now absent, per membership
+        self.day_absent_slots = {} # The same on each day, fixed when the day is first asked about
+        self.absences = {} # Earlier day -> who was absent then
+    def index(self,memberships,membership_offsets,membership_ids,layers):
+        # The memberships of person are membership_ids[membership_offsets[person]:membership_offsets[person+1]]
+        self.memberships = memberships
+        self.membership_offsets = membership_offsets
+        self.membership_ids = membership_ids
+        self.layers = layers
+        self.absent_slots = [0] * len(memberships)
+        for person in self.absentees:
+            for index in self.memberships_of(person):
+                self.absent_slots[index] += memberships[index].weight(person)
+        self.day_absent_slots = {}
+    def update(self):
+        self.roster.update()
+        for mapping in (self.day_absent_slots,self.absences):
+            for oldday in [oldday for oldday in mapping if oldday <= self.roster.day - self.retention_days]:
+                del mapping[oldday]
+    def memberships_of(self,person):
+        if person + 1 >= len(self.membership_offsets):
+            return ()
+        return self.membership_ids[self.membership_offsets[person]:self.membership_offsets[person+1]]
+    def set_state(self,person,state):
+        # False when person already had that state
+        if (state == 0) == (person in self.absentees):
+            return False
+        if state == 0:
+            self.roster.absent(person)
+            self.absentees[person] = True
+            change = 1
+        else:
+            self.roster.present(person)
+            del self.absentees[person]
+            change = -1
+        for index in self.memberships_of(person):
+            self.absent_slots[index] += change * self.memberships[index].weight(person)
+        for context in self.layers:
+            if person in context.person_data:
+                if state == 1:
+                    context.present(person)
+                else:
+                    context.absent(person)
+        return True
+    def absent_on(self,day):
+        # Days that are over no longer change, so each is listed once
+        if day not in self.absences:
+            self.absences[day] = set(self.roster.absentees(self.roster.day - day))
+        return self.absences[day]
+    def absent_slots_on(self,day):
+        # Fixed the first time the day is asked about, as a context's factor is when it
+        # rolls to the day: today's from attendance as it stands, after the day's
+        # departures, and an earlier day's from who the roster says was away then
+        if day not in self.day_absent_slots:
+            if day >= self.roster.day:
+                self.day_absent_slots[day] = list(self.absent_slots)
+            else:
+                slots = [0] * len(self.memberships)
+                for person in self.absent_on(day):
+                    for index in self.memberships_of(person):
+                        slots[index] += self.memberships[index].weight(person)
+                self.day_absent_slots[day] = slots
+        return self.day_absent_slots[day]
+    def distancing(self,transmit,receive,day):
+        # Same scaling as SimpleContact.compute_factor for a context on memberships transmit and receive
+        absent_slots = self.absent_slots_on(day)
+        total = self.memberships[transmit].total_length() + self.memberships[receive].total_length()
+        return (total - absent_slots[transmit] - absent_slots[receive]) / total
+
 class SparseContact(object):
-    def __init__(self):
-        self.roster = EasyTracker()
+    def __init__(self,retention_days=7):
+        self.roster = EasyTracker(retention_days)
+        self.retention_days = retention_days
         self.person_data = {}
         self.pair_data = {}
-        self.execution_data = {0 : {}}
+        self.execution_data = {}
         self.pairs = 0
         self.day = 0
         self.parent = None
         self.id = None
+        self.seed = None # With a seed, each product set draws from its own (seed,context,day,set) stream
     def _set_parent(self,parent,id):
         self.parent = parent
         self.id = id
     def add_product_set(self,transmitlist,receivelist,dayweight):
+        newcomers = []
         for actionlist in [transmitlist,receivelist]:
             for person in actionlist:
                 if person not in self.person_data:
                     self.person_data[person] = {}
                     self.person_data[person]['events'] = []
-                if self.pairs not in self.person_data[person]['events']:
-                    self.person_data[person]['events'].append(self.pairs)
-                if self.parent is not None:
-                    for day in range(7):
-                        self.parent._register(person,self.id,day)
-        pairlist = []
-        for persona in transmitlist:
-            for personb in receivelist:
-                if persona != personb:
-                    pairlist.append((persona,personb))
-        self.pair_data[self.pairs] = [pairlist,dayweight]
+                    newcomers.append(person)
+                events = self.person_data[person]['events']
+                if len(events) == 0 or events[-1] != self.pairs: # Product sets are numbered in order
+                    events.append(self.pairs)
+        if self.parent is not None and len(newcomers) > 0:
+            self.parent._register_week(newcomers,self.id)
+        # Only the two member lists are kept; the pairs (a,b) with a != b are implicit
+        transmitters = tuple(transmitlist)
+        receivers = tuple(receivelist)
+        overlap = {}
+        for person in receivers:
+            overlap[person] = overlap.get(person,0) + 1
+        paircount = len(transmitters) * len(receivers)
+        for person in transmitters:
+            paircount -= overlap.get(person,0)
+        self.pair_data[self.pairs] = [transmitters,receivers,dayweight,paircount]
         self.pairs += 1
     def update(self):
         self.day += 1
         self.roster.update()
-        self.execution_data[self.day] = {}
-        if self.day-7 in self.execution_data:
-            del self.execution_data[self.day-7]
+        self._day_record(0)
+        if self.day-self.retention_days in self.execution_data:
+            del self.execution_data[self.day-self.retention_days]
     def absent(self,person):
         self.roster.absent(person)
     def present(self,person):
         self.roster.present(person)
-    def _execute_product(self,index,daydiff = 0):
-        if self.day-daydiff in self.execution_data and index in self.execution_data[self.day-daydiff]:
-            return self.execution_data[self.day-daydiff][index]
+    def _day_record(self,daydiff):
+        # Pairs executed on a day are indexed by both endpoints as they are drawn
         if self.day-daydiff not in self.execution_data:
-            self.execution_data[self.day-daydiff] = {}
-        self.execution_data[self.day-daydiff][index] = []
-        howmany = probtools.draw(self.pair_data[index][1][(self.day-daydiff)%7]*len(self.pair_data[index][0]))
-        for count in range(howmany):
-            pairno = random.randrange(0,len(self.pair_data[index][0]))
-            self.execution_data[self.day-daydiff][index].append(self.pair_data[index][0][pairno])
-        return self.execution_data[self.day-daydiff][index]
-    def query_transmit(self,person,day=None):
-        if day is not None:
-            if day > self.day:
-                self.update()
-            daydiff = day - self.day
-        else:
-            daydiff = 0
-
-        if self.roster.poll_absent(person,daydiff) is True:
-            return {}
-        returndict = {}
+            self.execution_data[self.day-daydiff] = {'products' : {}, 'transmit' : {}, 'receive' : {}}
+        return self.execution_data[self.day-daydiff]
+    def _index_pair(self,daydata,persona,personb,count=1):
+        for side,first,second in (('transmit',persona,personb),('receive',personb,persona)):
+            if first not in daydata[side]:
+                daydata[side][first] = {second : count}
+            elif second not in daydata[side][first]:
+                daydata[side][first][second] = count
+            else:
+                daydata[side][first][second] += count
+    def _draw_product(self,index,day):
+        # The pairs product set index executes on day, present or not
+        transmitters,receivers,dayweight,paircount = self.pair_data[index]
+        rng = random if self.seed is None else KeyedStream(stream_key(self.seed,self.id,day),index)
+        howmany = probtools.draw(dayweight[day%7]*paircount,rng)
+        pairs = []
+        while howmany > 0:
+            # Uniform over the product, rejecting a == b, is uniform over the valid pairs
+            persona = transmitters[rng.randrange(len(transmitters))]
+            personb = receivers[rng.randrange(len(receivers))]
+            if persona != personb:
+                pairs.append((persona,personb))
+                howmany -= 1
+        return pairs
+    def _execute_product(self,index,daydata,day):
+        daydata['products'][index] = True
+        for persona,personb in self._draw_product(index,day):
+            self._index_pair(daydata,persona,personb)
+    def realize_day(self,day):
+        # Every pair of the day, whatever anyone's attendance; the queries above thin
+        # the same draws to who is present
+        pairs = []
+        for index in self.pair_data:
+            pairs.extend(self._draw_product(index,day))
+        return pairs
+    def _executed(self,person,daydiff):
+        daydata = self._day_record(daydiff)
         for itemid in self.person_data[person]['events']:
-            pairs = self._execute_product(itemid,daydiff)
-            for pair in pairs:
-                if pair[0] == person and self.roster.poll_absent(pair[1],daydiff) is False:
-                    returndict = dictionary_sum(returndict,{pair[1]:1})
-        return returndict
-    def query_receive(self,person,day=None):
-        if day is not None:
-            if day > self.day:
-                self.update()
-            daydiff = day - self.day
-        else:
-            daydiff = 0
+            if itemid not in daydata['products']:
+                self._execute_product(itemid,daydata,self.day-daydiff)
+        return daydata
+    def _daydiff(self,day):
+        # Days back from the latest day seen; catches up if queries skipped some days
+        if day is None:
+            return 0
+        while day > self.day:
+            self.update()
+        return self.day - day
+    def _query_side(self,side,person,day,into):
+        daydiff = self._daydiff(day)
+        if into is None:
+            into = ContactAccumulator()
         if self.roster.poll_absent(person,daydiff) is True:
-            return {}
-        returndict = {}
-        for itemid in self.person_data[person]['events']:
-            pairs = self._execute_product(itemid,daydiff)
-            for pair in pairs:
-                if pair[1] == person and self.roster.poll_absent(pair[0],daydiff) is False:
-                    returndict = dictionary_sum(returndict,{pair[0]:1})
-        return returndict
-    def query_contacts(self,person,day=None):
-        return dictionary_sum(self.query_transmit(person,day),self.query_receive(person,day))
+            return into
+        partners = self._executed(person,daydiff)[side].get(person)
+        if partners is not None:
+            for partner,count in partners.items():
+                if self.roster.poll_absent(partner,daydiff) is False:
+                    into.add(partner,count)
+        return into
+    def query_transmit(self,person,day=None,into=None):
+        return self._query_side('transmit',person,day,into)
+    def query_receive(self,person,day=None,into=None):
+        return self._query_side('receive',person,day,into)
+    def query_contacts(self,person,day=None,into=None):
+        into = self.query_transmit(person,day,into)
+        return self.query_receive(person,day,into)
+    def query_transmit_many(self,persons,day=None):
+        return [self._query_side('transmit',person,day,None) for person in persons]
+    def query_contacts_many(self,persons,day=None):
+        return [self.query_contacts(person,day) for person in persons]
 
 
 
 
 class PermanentContact(SparseContact):
-    def __init__(self):
-        super().__init__()
+    # Every pair meets every day, so nothing is drawn or cached per day: person_data
+    # holds each person's neighbors on both sides with the number of pairs joining them
+    def __init__(self,retention_days=7):
+        super().__init__(retention_days)
         self.rate = 1
-    def _execute_product(self,index,daydiff=0):
-        result = []
-        for pair in self.pair_data[index][0]:
-            result += [pair] * self.rate
-        return result
+    def add_product_set(self,transmitlist,receivelist,dayweight):
+        newcomers = []
+        for actionlist in [transmitlist,receivelist]:
+            for person in actionlist:
+                if person not in self.person_data:
+                    self.person_data[person] = {'transmit' : {}, 'receive' : {}}
+                    newcomers.append(person)
+        if self.parent is not None and len(newcomers) > 0:
+            self.parent._register_week(newcomers,self.id)
+        for persona in transmitlist:
+            for personb in receivelist:
+                if persona != personb:
+                    for side,first,second in (('transmit',persona,personb),('receive',personb,persona)):
+                        neighbors = self.person_data[first][side]
+                        neighbors[second] = neighbors.get(second,0) + 1
+        self.pairs += 1
+    def update(self):
+        self.day += 1
+        self.roster.update()
+    def _query_side(self,side,person,day,into):
+        daydiff = self._daydiff(day)
+        if into is None:
+            into = ContactAccumulator()
+        if person not in self.person_data or self.roster.poll_absent(person,daydiff) is True:
+            return into
+        rate = self.rate
+        poll_absent = self.roster.poll_absent
+        for partner,count in self.person_data[person][side].items():
+            if poll_absent(partner,daydiff) is False:
+                into.add(partner,count * rate)
+        return into
     def _test(self):
         return
         #print(self.pair_data)
@@ -293,12 +811,23 @@ class PermanentContact(SparseContact):
 
 
 class SimpleContact(object):
-    def __init__(self,day=None):
-        self.transmitters = PersonTracker()
-        self.receivers = PersonTracker()
-        self.transmit_events = {}
-        self.receive_events = {}
-        self.contact_events = {}
+    def __init__(self,day=None,retention_days=7,like=None):
+        if like is None:
+            self.transmit_membership = Membership()
+            self.receive_membership = Membership()
+        else:
+            # Same people as another context (usually another meeting day): share its memberships
+            # until either context adds anyone
+            self.transmit_membership = like.transmit_membership
+            self.receive_membership = like.receive_membership
+        self.transmit_membership.holders += 1
+        self.receive_membership.holders += 1
+        # Trackers and event records are built by _materialize() when the context is first used
+        self.transmitters = None
+        self.receivers = None
+        self.transmit_events = None
+        self.receive_events = None
+        self.contact_events = None
         self.rate_factor = 1.0
         self.social_distance_enabled = False
         self.effective_factor = 1.0
@@ -308,17 +837,82 @@ class SimpleContact(object):
         self.previous_day = None
         self.traceable = True
         self.message = ''
+        self.queries_today = [0,0] # Today's transmit and receive draws made person by person, singly or in batches
+        self.day_population = [0,0] # Today's active transmitter and receiver slots
+        self.exhaust_threshold = 0.5 # Fraction of a side's slots queried before sampling the whole day
+        self.retention_days = retention_days
+        self.history = {} # Earlier days still inside the tracing window, by day
+        self.rate_version = 0 # Bumped whenever transmit_rate() may have changed
+        self.rated = None
+        # With a seed, a transmitter's draws on a day come from their own (seed,context,day,person)
+        # stream, thinned against that day's absences, so no answer depends on query order
+        self.seed = None
+        self.today = None
     def _set_parent(self,parent,id):
         self.parent = parent
         self.id = id
     def set_rate(self,ratevalue):
         self.rate_factor = ratevalue
+    def _materialize(self):
+        # Attendance recorded on the memberships before this is applied by the first activate()
+        if self.transmitters is None:
+            self.transmitters = PersonTracker(self.transmit_membership)
+            self.receivers = PersonTracker(self.receive_membership)
+            self.transmit_events = {}
+            self.receive_events = {}
+            self.contact_events = {}
+    def members(self):
+        # Everyone in the context, in the form CompoundContact._register takes
+        members = dict.fromkeys(self.transmit_membership.positions,True)
+        members.update(dict.fromkeys(self.receive_membership.positions,True))
+        return members
+    def add_members(self,persobj,*remainder,multiplicity=1):
+        # The same people on both sides: while both are empty they share one membership
+        # from the start instead of being built twice and shared by finalize
+        if self.transmitters is None and self.transmit_membership.total_length() == 0 and self.receive_membership.total_length() == 0:
+            self._hold(self.transmit_membership,self.transmit_membership)
+        if self.transmit_membership is not self.receive_membership:
+            self.add_transmitters(persobj,multiplicity=multiplicity)
+            self.add_receivers(persobj,multiplicity=multiplicity)
+            return
+        if self.transmit_membership.holders > 2:
+            membership = self.transmit_membership.copy()
+            self._hold(membership,membership)
+        if self.transmitters is None:
+            self.transmit_membership.add(persobj,multiplicity)
+        else:
+            self.transmitters.add(persobj,multiplicity)
+            self.receivers.grow()
+        if self.parent is not None:
+            self.parent._register(persobj,self.id,self.day)
+    def _hold(self,transmit,receive):
+        # Keeps the holder counts of the memberships the two sides move between
+        for membership in (self.transmit_membership,self.receive_membership):
+            membership.holders -= 1
+        for membership in (transmit,receive):
+            membership.holders += 1
+        self.transmit_membership = transmit
+        self.receive_membership = receive
+        if self.transmitters is not None:
+            self.transmitters.membership = transmit
+            self.receivers.membership = receive
     def add_transmitters(self,persobj,*remainder,multiplicity=1):
-        self.transmitters.add(persobj,multiplicity)
+        # Copy on write: another side or context holding the membership keeps its people
+        if self.transmit_membership.holders > 1:
+            self._hold(self.transmit_membership.copy(),self.receive_membership)
+        if self.transmitters is None:
+            self.transmit_membership.add(persobj,multiplicity)
+        else:
+            self.transmitters.add(persobj,multiplicity)
         if self.parent is not None:
             self.parent._register(persobj,self.id,self.day)
     def add_receivers(self,persobj,*remainder,multiplicity=1):
-        self.receivers.add(persobj,multiplicity)
+        if self.receive_membership.holders > 1:
+            self._hold(self.transmit_membership,self.receive_membership.copy())
+        if self.receivers is None:
+            self.receive_membership.add(persobj,multiplicity)
+        else:
+            self.receivers.add(persobj,multiplicity)
         if self.parent is not None:
             self.parent._register(persobj,self.id,self.day)
     def compute_factor(self):
@@ -327,16 +921,20 @@ class SimpleContact(object):
         else:
             self.effective_factor = self.rate_factor
     def present(self,person):
+        self._materialize()
         self.transmitters.set_state(person,1)
         self.receivers.set_state(person,1)
     def absent(self,person):
+        self._materialize()
         self.transmitters.set_state(person,0)
         self.receivers.set_state(person,0)
     def initialize(self):
+        self._materialize()
         self.transmitters.deactivate()
         self.receivers.deactivate()
         self.compute_factor()
     def update(self):
+        self._materialize()
         self.transmitters.activate()
         self.transmitters.deactivate()
         self.receivers.activate()
@@ -344,142 +942,1103 @@ class SimpleContact(object):
         self.transmit_events = {}
         self.receive_events = {}
         self.contact_events = {}
+        self.queries_today = [0,0]
+        self.day_population = [self.transmitters.active_length(),self.receivers.active_length()]
         self.compute_factor()
+        rated = (self.effective_factor,self.receivers.proposal_length())
+        if rated != self.rated:
+            self.rated = rated
+            self.rate_version += 1
+    def _dense_query(self,side,count=1):
+        # Once enough of today's people on one side (0 transmit, 1 receive) have been
+        # queried, singly or in batches, it is cheaper to draw the rest of the day in a single pass
+        self.queries_today[side] += count
+        if self.transmitters.active or self.queries_today[side] <= self.exhaust_threshold * self.day_population[side]:
+            return False
+        self.exhaust()
+        return True
+    def exhaust(self):
+        # Every transmitter and receiver not yet queried today is paired off at once;
+        # the superposition of their Poisson processes picks both ends uniformly
+        transmit_slots = self.transmitters.active_length()
+        receive_slots = self.receivers.active_length()
+        howmany = probtools.draw(self.effective_factor * transmit_slots * receive_slots)
+        transmit_events = self.transmit_events
+        receive_events = self.receive_events
+        for source,target in zip(self.transmitters.sample(howmany),self.receivers.sample(howmany)):
+            if source == target:
+                continue
+            if source not in transmit_events:
+                transmit_events[source] = {target : 1}
+            elif target not in transmit_events[source]:
+                transmit_events[source][target] = 1
+            else:
+                transmit_events[source][target] += 1
+            if target not in receive_events:
+                receive_events[target] = {source : 1}
+            elif source not in receive_events[target]:
+                receive_events[target][source] = 1
+            else:
+                receive_events[target][source] += 1
+        self.transmitters.settle()
+        self.receivers.settle()
     def _grab_from(self,which_list,weight,sourceindividual):
         rate = self.effective_factor * weight * which_list.active_length()
         howmany = probtools.draw(rate)
         result_dict = {}
-        for person in range(howmany):
-            whoitis = which_list.random()
+        for whoitis in which_list.sample(howmany):
             if whoitis != sourceindividual:
-                result_dict = dictionary_sum(result_dict,{whoitis : 1})
+                if whoitis in result_dict:
+                    result_dict[whoitis] += 1
+                else:
+                    result_dict[whoitis] = 1
         return result_dict
-    def query_transmit(self,person,day=None):
-        if day is not None and day != self.previous_day:
-            self.update() # This works because each one is only run once each week
-            self.previous_day = day
+    def _record_reciprocal(self,events,person,new_information):
+        # Each contact found from person's side is also filed under the other party
+        for key,value in new_information.items():
+            if key not in events:
+                events[key] = {person : value}
+            elif person not in events[key]:
+                events[key][person] = value
+            else:
+                events[key][person] += value
+    def _answer(self,events,into):
+        if into is not None:
+            return into.merge(events)
+        return events
+    def _select_day(self,day):
+        # None means the current day; an earlier day gets its own record
+        self._materialize()
+        if day is None or day == self.previous_day:
+            return None
+        if (self.previous_day is None or day > self.previous_day) and (self.parent is None or day >= self.parent.day):
+            self._roll(day)
+            return None
+        if day not in self.history:
+            # Never sampled while current, so nothing was realized; start it afresh
+            self._remember(day,self._freeze_past(day))
+        return self.history[day]
+    def _remember(self,day,record):
+        # The parent sweeps contexts holding earlier days, so quiet ones drop them too
+        self.history[day] = record
+        if self.parent is not None:
+            self.parent.remembering.add(self)
+    def _forget(self,day):
+        # Drops the days that are out of the tracing window once it is day
+        for oldday in [oldday for oldday in self.history if oldday <= day - self.retention_days]:
+            del self.history[oldday]
+    def _roll(self,day):
+        if self.previous_day is not None and self.previous_day > day - self.retention_days:
+            if self.today is not None and self.today['day'] == self.previous_day:
+                self._remember(self.previous_day,self.today)
+            else:
+                self._remember(self.previous_day,self._freeze())
+        self._forget(day)
+        self.update() # This works because each one is only run once each week
+        self.previous_day = day
+    def realize_day(self,day):
+        # Every contact of the day drawn over all members, present or not, at the
+        # undistanced rate, each with a uniform mark: those between present people with
+        # a mark below the day's distancing factor are a draw of the day's contacts
+        # Subkey -1 keeps the whole day's stream apart from every person's
+        rng = random if self.seed is None else KeyedStream(stream_key(self.seed,self.id,day),-1)
+        transmit = self.transmit_membership
+        receive = self.receive_membership
+        howmany = probtools.draw(self.rate_factor * transmit.total_length() * receive.total_length(),rng)
+        pairs = [(source,target) for source,target in zip(transmit.draw(howmany,rng),receive.draw(howmany,rng)) if source != target]
+        return pairs,[rng.random() for pair in pairs]
+    def _freeze(self,fresh=False):
+        # Everything needed to keep answering a day lazily after it stops being current
+        if fresh:
+            return {'transmit' : {}, 'receive' : {}, 'contact' : {}, 'factor' : self.effective_factor,
+                'transmitters' : self.transmitters.day_snapshot(True), 'receivers' : self.receivers.day_snapshot(True)}
+        return {'transmit' : self.transmit_events, 'receive' : self.receive_events, 'contact' : self.contact_events,
+            'factor' : self.effective_factor, 'transmitters' : self.transmitters.day_snapshot(), 'receivers' : self.receivers.day_snapshot()}
+    def _freeze_past(self,day):
+        # A day that ended before this context reached it: who was off comes from the
+        # parent's attendance for that day, since the trackers only know the latest
+        if self.parent is None:
+            return self._freeze(True)
+        self._forget(self.parent.day)
+        absent = self.parent.attendance.absent_on(day)
+        snapshots = []
+        for tracker in (self.transmitters,self.receivers):
+            off = set(person for person in absent if tracker.weight(person) > 0)
+            snapshots.append({'off' : off, 'done' : set(), 'available' : tracker.total_length() - sum(tracker.weight(person) for person in off)})
+        factor = self.rate_factor
+        if self.social_distance_enabled:
+            factor *= (snapshots[0]['available'] + snapshots[1]['available'])/(self.transmitters.total_length() + self.receivers.total_length())
+        return {'transmit' : {}, 'receive' : {}, 'contact' : {}, 'factor' : factor, 'transmitters' : snapshots[0], 'receivers' : snapshots[1]}
+    def _query_past(self,record,side,person):
+        return self._query_past_many(record,side,(person,))[0]
+    def _query_past_many(self,record,side,persons):
+        # Queries from one side only mark that side done, so persons share one draw of the other
+        if side == 'transmit':
+            mine,theirs,my_tracker,their_tracker,other_side = record['transmitters'],record['receivers'],self.transmitters,self.receivers,'receive'
+        else:
+            mine,theirs,my_tracker,their_tracker,other_side = record['receivers'],record['transmitters'],self.receivers,self.transmitters,'transmit'
+        events = record[side]
+        drawing = {}
+        for person in persons:
+            if person not in events:
+                events[person] = {}
+            weight = my_tracker.weight(person)
+            if weight == 0 or person in mine['off'] or person in mine['done']:
+                continue
+            mine['done'].add(person)
+            mine['available'] -= weight
+            drawing[person] = probtools.draw(record['factor'] * weight * theirs['available'])
+        howmany = sum(drawing.values())
+        # The day's partition is gone, so draw from everyone and thin out whoever was
+        # off or already queried; fall back to an explicit list when most are excluded
+        off = theirs['off']
+        done = theirs['done']
+        membership = their_tracker.membership
+        drawn = []
+        if 4 * theirs['available'] >= membership.total_length():
+            while len(drawn) < howmany:
+                drawn.extend(whoitis for whoitis in membership.draw(howmany - len(drawn)) if whoitis not in off and whoitis not in done)
+        elif howmany > 0:
+            candidates = [whoitis for whoitis in membership.people if whoitis not in off and whoitis not in done]
+            drawn = random.choices(candidates,weights=[membership.weight(whoitis) for whoitis in candidates],k=howmany)
+        self._record_drawn(events,record[other_side],drawing,drawn)
+        return [events[person] for person in persons]
+    def _record_drawn(self,events,other_events,drawing,drawn):
+        # Hands out one shared sample in order, count by count, to the persons in drawing
+        start = 0
+        for person,count in drawing.items():
+            new_information = {}
+            for whoitis in drawn[start:start+count]:
+                if whoitis != person:
+                    new_information[whoitis] = new_information.get(whoitis,0) + 1
+            start += count
+            self._record_reciprocal(other_events,person,new_information)
+            events[person] = dictionary_sum(events[person],new_information)
+    def _keyed_record(self,day):
+        # With a seed the current day is answered from a record as well
+        record = self._select_day(day)
+        if record is None:
+            if self.today is None or self.today['day'] != self.previous_day:
+                self.today = self._freeze(True)
+                self.today['day'] = self.previous_day
+            return self.today
+        if 'day' not in record:
+            record['day'] = day
+        return record
+    def _keyed_stream(self,record,person):
+        # person's stream on the record's day; the day's key is hashed once
+        if 'key' not in record:
+            record['key'] = stream_key(self.seed,self.id,record['day'])
+        return KeyedStream(record['key'],person)
+    def _keyed_transmit(self,record,person):
+        events = record['transmit']
+        if person in events:
+            return events[person]
+        events[person] = {}
+        weight = self.transmit_membership.weight(person)
+        receivers = self.receive_membership
+        if weight == 0 or receivers.total_length() == 0 or person in record['transmitters']['off']:
+            return events[person]
+        rng = self._keyed_stream(record,person)
+        howmany = probtools.draw(record['factor'] * weight * receivers.total_length(),rng)
+        if howmany == 0: # About half of a day's transmitters in the broad contexts
+            return events[person]
+        off = record['receivers']['off']
+        drawn = events[person]
+        for whoitis in receivers.draw(howmany,rng):
+            if whoitis != person and whoitis not in off:
+                drawn[whoitis] = drawn.get(whoitis,0) + 1
+        return drawn
+    def _keyed_receive(self,record,person):
+        # Who reached person depends on every transmitter's stream, so the whole day is drawn once
+        if 'complete' not in record:
+            for transmitter in self.transmit_membership.positions:
+                self._keyed_transmit(record,transmitter)
+            self._record_reciprocal_all(record['transmit'],record['receive'])
+            record['complete'] = True
+        if person not in record['receive']:
+            record['receive'][person] = {}
+        return record['receive'][person]
+    def _record_reciprocal_all(self,events,other_events):
+        for person,new_information in events.items():
+            self._record_reciprocal(other_events,person,new_information)
+    def transmit_rate(self,person):
+        # Today's rate of transmit proposals for person, spread over receivers.proposal_length()
+        return self.effective_factor * self.transmitters.weight(person) * self.receivers.proposal_length()
+    def _open_transmit(self,person):
+        # Whether person still needs today's transmit draw here
         if person not in self.transmit_events:
             self.transmit_events[person] = {}
-        if self.transmitters.get_state(person) != 1: # Invalid or inactive
+        return self.transmitters.get_state(person) == 1 and not self._dense_query(0) # Invalid, inactive or already drawn
+    def _realize_transmit(self,person,proposals):
+        # Today's transmit draw for person from a proposal count made elsewhere
+        if not self._open_transmit(person):
             return self.transmit_events[person]
+        self.transmitters.touch(person)
+        new_information = {}
+        for whoitis in self.receivers.thin(proposals):
+            if whoitis != person:
+                new_information[whoitis] = new_information.get(whoitis,0) + 1
+        self._record_reciprocal(self.receive_events,person,new_information)
+        self.transmit_events[person] = dictionary_sum(self.transmit_events[person],new_information)
+        return self.transmit_events[person]
+    def query_transmit(self,person,day=None,into=None):
+        if self.seed is not None:
+            return self._answer(self._keyed_transmit(self._keyed_record(day),person),into)
+        record = self._select_day(day)
+        if record is not None:
+            return self._answer(self._query_past(record,'transmit',person),into)
+        if not self._open_transmit(person):
+            return self._answer(self.transmit_events[person],into)
         weight = self.transmitters.weight(person)
         self.transmitters.touch(person)
         new_information = self._grab_from(self.receivers,weight,person)
-        for key in new_information:
-            value = new_information[key]
-            if key not in self.receive_events:
-                self.receive_events[key] = {}
-            self.receive_events[key] = dictionary_sum(self.receive_events[key],{person : value})
+        self._record_reciprocal(self.receive_events,person,new_information)
         self.transmit_events[person] = dictionary_sum(self.transmit_events[person],new_information)
-        return self.transmit_events[person]
-    def query_receive(self,person,day=None):
-        if day is not None and day != self.previous_day:
-            self.update()
-            self.previous_day = day
+        return self._answer(self.transmit_events[person],into)
+    def _query_side_many(self,side,persons,day):
+        # Events of each of persons on one side; the draws share one sample of the
+        # other side, which no query from this side changes
+        if self.seed is not None:
+            query = self.query_transmit if side == 'transmit' else self.query_receive
+            return [query(person,day) for person in persons]
+        record = self._select_day(day)
+        if record is not None:
+            return self._query_past_many(record,side,persons)
+        if side == 'transmit':
+            mine,theirs,events,other_events,index = self.transmitters,self.receivers,self.transmit_events,self.receive_events,0
+        else:
+            mine,theirs,events,other_events,index = self.receivers,self.transmitters,self.receive_events,self.transmit_events,1
+        drawing = {}
+        for person in persons:
+            if person not in events:
+                events[person] = {}
+            if person not in drawing and mine.get_state(person) == 1:
+                drawing[person] = probtools.draw(self.effective_factor * mine.weight(person) * theirs.active_length())
+                mine.touch(person)
+        # The batch counts toward _dense_query only once the other side is sampled, so
+        # no exhaust() can settle it while the batch is still being drawn
+        self._record_drawn(events,other_events,drawing,theirs.sample(sum(drawing.values())))
+        self._dense_query(index,len(drawing))
+        return [events[person] for person in persons]
+    def query_transmit_many(self,persons,day=None):
+        return self._query_side_many('transmit',persons,day)
+    def query_receive(self,person,day=None,into=None):
+        if self.seed is not None:
+            return self._answer(self._keyed_receive(self._keyed_record(day),person),into)
+        record = self._select_day(day)
+        if record is not None:
+            return self._answer(self._query_past(record,'receive',person),into)
         if person not in self.receive_events:
             self.receive_events[person] = {}
-        if self.receivers.get_state(person) != 1: # Invalid or inactive
-            return self.receive_events[person]
+        if self.receivers.get_state(person) != 1 or self._dense_query(1): # Invalid, inactive or already drawn
+            return self._answer(self.receive_events[person],into)
         weight = self.receivers.weight(person)
         self.receivers.touch(person)
         new_information = self._grab_from(self.transmitters,weight,person)
-        for key in new_information:
-            value = new_information[key]
-            if key not in self.transmit_events:
-                self.transmit_events[key] = {}
-            self.transmit_events[key] = dictionary_sum(self.transmit_events[key],{person : value})
+        self._record_reciprocal(self.transmit_events,person,new_information)
         self.receive_events[person] = dictionary_sum(self.receive_events[person],new_information)
-        return self.receive_events[person]
-    def query_contacts(self,person,day=None):
+        return self._answer(self.receive_events[person],into)
+    def _draw_contacts(self,person):
+        # With one membership on both sides, both directions come from a single draw:
+        # the two Poisson processes superpose, and which side's slots a draw lands in
+        # says whether it was transmitted or received
+        transmitters = self.transmitters
+        receivers = self.receivers
+        if transmitters.get_state(person) != 1 or receivers.get_state(person) != 1:
+            return dictionary_sum_copy(self.query_transmit(person),self.query_receive(person))
+        for events in (self.transmit_events,self.receive_events):
+            if person not in events:
+                events[person] = {}
+        if not self._dense_query(0):
+            weight = transmitters.weight(person)
+            transmitters.touch(person)
+            receivers.touch(person)
+            receive_slots = receivers.active_length()
+            transmit_slots = transmitters.active_length()
+            howmany = probtools.draw(self.effective_factor * weight * (receive_slots + transmit_slots))
+            to_receivers = 0
+            for index in range(howmany):
+                if random.randrange(receive_slots + transmit_slots) < receive_slots:
+                    to_receivers += 1
+            sent = {}
+            received = {}
+            for whoitis in receivers.sample(to_receivers):
+                if whoitis != person:
+                    sent[whoitis] = sent.get(whoitis,0) + 1
+            for whoitis in transmitters.sample(howmany - to_receivers):
+                if whoitis != person:
+                    received[whoitis] = received.get(whoitis,0) + 1
+            self._record_reciprocal(self.receive_events,person,sent)
+            self._record_reciprocal(self.transmit_events,person,received)
+            self.transmit_events[person] = dictionary_sum(self.transmit_events[person],sent)
+            self.receive_events[person] = dictionary_sum(self.receive_events[person],received)
+        return dictionary_sum_copy(self.transmit_events[person],self.receive_events[person])
+    def query_contacts(self,person,day=None,into=None):
         if not self.traceable:
-            return {}
-        if person not in self.contact_events:
-            self.contact_events[person] = dictionary_sum_copy(self.query_transmit(person,day),self.query_receive(person,day))
-        return self.contact_events[person]
+            return {} if into is None else into
+        if self.seed is not None:
+            record = self._keyed_record(day)
+            if person not in record['contact']:
+                record['contact'][person] = dictionary_sum_copy(self._keyed_transmit(record,person),self._keyed_receive(record,person))
+            return self._answer(record['contact'][person],into)
+        record = self._select_day(day)
+        contact_events = self.contact_events if record is None else record['contact']
+        if person not in contact_events:
+            if record is None and self.transmit_membership is self.receive_membership:
+                contact_events[person] = self._draw_contacts(person)
+            else:
+                contact_events[person] = dictionary_sum_copy(self.query_transmit(person,day),self.query_receive(person,day))
+        return self._answer(contact_events[person],into)
+    def query_contacts_many(self,persons,day=None):
+        # One batch per side: the lazy draws realize each pair once whatever the order
+        # of the queries, so transmitting all first and then receiving is still exact
+        if not self.traceable:
+            return [{} for person in persons]
+        if self.seed is not None:
+            return [self.query_contacts(person,day) for person in persons]
+        record = self._select_day(day)
+        contact_events = self.contact_events if record is None else record['contact']
+        missing = [person for person in dict.fromkeys(persons) if person not in contact_events]
+        if len(missing) > 0:
+            sent = self._query_side_many('transmit',missing,day)
+            received = self._query_side_many('receive',missing,day)
+            for person,transmitted,reached in zip(missing,sent,received):
+                contact_events[person] = dictionary_sum_copy(transmitted,reached)
+        return [contact_events[person] for person in persons]
 
 
 
 class CompoundContact(object):
-    def __init__(self):
+    def __init__(self,retention_days=7):
+        self.retention_days = retention_days # Days of history kept for contact tracing lookback
         self.simplecontacts = {}
-        self.agents = {}
-        self.contacts_by_day = {}
+        # Registrations as (person,context,weekday) triples until finalize(); weekday -1 is every day
+        self.registered_people = array.array('l')
+        self.registered_contexts = array.array('l')
+        self.registered_days = array.array('l')
         self.contact_count = 0
         self.day = 0
         self.target = 0
+        # Compressed sparse rows built by finalize(): the contexts of person on a
+        # weekday are day_contexts[day_offsets[7*person+weekday]:day_offsets[7*person+weekday+1]]
+        # and all of their contexts are agent_contexts[agent_offsets[person]:agent_offsets[person+1]]
+        self.population = 0
+        self.agent_count = 0
+        self.day_offsets = None
+        self.day_contexts = None
+        self.agent_offsets = None
+        self.agent_contexts = None
+        # Attendance is recorded once per distinct membership, whatever number of
+        # contexts share it; the sparse layers keep their own rosters
+        self.memberships = []
+        self.roster_contexts = []
+        self.alias_tables = None # 7*person+weekday -> (context rate versions,AliasTable), once enabled
+        self.attendance = Attendance(retention_days)
+        self.remembering = set() # Simple contexts holding earlier days, swept by update()
     def update(self):
         self.day += 1
+        self.attendance.update()
+        for context in list(self.remembering):
+            context._forget(self.day)
+            if len(context.history) == 0:
+                self.remembering.discard(context)
+        # Roster contexts date attendance changes by their own day, so they cannot wait
+        # for a query to catch them up
+        for context in self.roster_contexts:
+            context.update()
     def _test(self,day_range):
+        self.finalize()
         total = 0
         self.day = 0
         print('----- Transmission Test (Target valid with no social distancing)')
         print('----- Transmission Test Target:',self.target)
         for day in range(day_range):
-            for person in self.agents:
+            for person in range(self.population):
+                if self.agent_offsets[person] == self.agent_offsets[person+1]:
+                    continue
                 cdict = self.query_transmit(person)
-                for key in cdict:
-                    total += cdict[key]
-            print('Day: %3i  ' % (day),'Average: %8.5f' % (total/(day+1)/len(self.agents)))
+                for value in cdict.values():
+                    total += value
+            print('Day: %3i  ' % (day),'Average: %8.5f' % (total/(day+1)/self.agent_count))
             self.update()
-        return (total/(day+1)/len(self.agents))
+        return (total/(day+1)/self.agent_count)
+    def finalize(self):
+        # Packs the registered triples into the index arrays once generation is done
+        if self.day_offsets is not None:
+            return
+        population = max(self.registered_people,default=-1) + 1
+        stride = self.contact_count
+        triples = list(zip(self.registered_people,self.registered_contexts,self.registered_days))
+        agent_keys = set([person * stride + contactid for person,contactid,weekday in triples])
+        day_keys = set([(7 * person + weekday) * stride + contactid for person,contactid,weekday in triples if weekday >= 0])
+        for person,contactid,weekday in triples:
+            if weekday < 0:
+                day_keys.update((7 * person + day) * stride + contactid for day in range(7))
+        day_offsets,day_contexts = self._rows(sorted(day_keys),7 * population,stride)
+        agent_offsets,agent_contexts = self._rows(sorted(agent_keys),population,stride)
+        membership_index = {}
+        person_memberships = {}
+        symmetric = {}
+        self.memberships = []
+        self.roster_contexts = []
+        for context in self.simplecontacts.values():
+            if not isinstance(context,SimpleContact):
+                self.roster_contexts.append(context)
+                continue
+            # The same list on both sides: both sides then draw on one membership
+            key = (id(context.transmit_membership),id(context.receive_membership))
+            if key not in symmetric:
+                symmetric[key] = context.transmit_membership.same_people(context.receive_membership)
+            if symmetric[key] and context.transmitters is None:
+                context._hold(context.transmit_membership,context.transmit_membership)
+            for membership in (context.transmit_membership,context.receive_membership):
+                if id(membership) in membership_index:
+                    continue
+                membership_index[id(membership)] = len(self.memberships)
+                for person in membership.positions:
+                    if person not in person_memberships:
+                        person_memberships[person] = []
+                    person_memberships[person].append(len(self.memberships))
+                self.memberships.append(membership)
+        membership_offsets = array.array('l',[0])
+        membership_ids = array.array('l')
+        for person in range(population):
+            if person in person_memberships:
+                membership_ids.extend(person_memberships[person])
+            membership_offsets.append(len(membership_ids))
+        self.attendance.index(self.memberships,membership_offsets,membership_ids,self.roster_contexts)
+        self.population = population
+        self.agent_count = len(set(key // stride for key in agent_keys))
+        self.day_offsets = day_offsets
+        self.day_contexts = day_contexts
+        self.agent_offsets = agent_offsets
+        self.agent_contexts = agent_contexts
+        self.registered_people = array.array('l')
+        self.registered_contexts = array.array('l')
+        self.registered_days = array.array('l')
+    def _rows(self,keys,rowcount,stride):
+        # Sorted row * stride + column keys to compressed rows
+        rows = [key // stride for key in keys]
+        offsets = array.array('l',[bisect.bisect_left(rows,row) for row in range(rowcount + 1)])
+        return offsets,array.array('l',[key % stride for key in keys])
+    def _unpack(self):
+        # Registration after finalize() (only the generation tests do this) goes back to triples
+        day_offsets = self.day_offsets
+        self.day_offsets = None
+        for person in range(self.population):
+            for weekday in range(7):
+                for id in self.day_contexts[day_offsets[7*person+weekday]:day_offsets[7*person+weekday+1]]:
+                    self._register(person,id,weekday)
+        self.day_contexts = None
+        self.agent_offsets = None
+        self.agent_contexts = None
+    def contexts_on(self,person,weekday):
+        row = 7 * person + weekday
+        if row + 1 >= len(self.day_offsets):
+            return ()
+        return self.day_contexts[self.day_offsets[row]:self.day_offsets[row+1]]
+    def contexts_of(self,person):
+        if person + 1 >= len(self.agent_offsets):
+            return ()
+        return self.agent_contexts[self.agent_offsets[person]:self.agent_offsets[person+1]]
 
-    def new_context(self,day,message=''):
-        newcontext = SimpleContact(day)
+    def new_context(self,day,message='',like=None):
+        newcontext = SimpleContact(day,self.retention_days,like)
         newcontext._set_parent(self,self.contact_count)
         newcontext.message = message
+        if like is not None:
+            self._register(newcontext.members(),newcontext.id,day)
         self.simplecontacts[self.contact_count] = newcontext
         self.contact_count += 1
         return newcontext
     def new_sparse(self,message=''):
-        newcontext = SparseContact()
+        newcontext = SparseContact(self.retention_days)
         newcontext._set_parent(self,self.contact_count)
         newcontext.message = message
         self.simplecontacts[self.contact_count] = newcontext
         self.contact_count += 1
         return newcontext
     def new_permanent(self,message=''):
-        newcontext = PermanentContact()
+        newcontext = PermanentContact(self.retention_days)
         newcontext._set_parent(self,self.contact_count)
         newcontext.message = message
         self.simplecontacts[self.contact_count] = newcontext
         self.contact_count += 1
         return newcontext
     def _register(self,persobj,id,day):
-        if type(persobj) != list and type(persobj) != dict:
+        if self.day_offsets is not None:
+            self._unpack()
+        if type(persobj) == dict:
+            persobj = list(persobj)
+        elif type(persobj) != list:
             persobj = [persobj]
-        for person in persobj:
-            if person not in self.agents:
-                self.agents[person] = {}
-                self.contacts_by_day[person] = {0 : {}, 1 : {}, 2 : {}, 3: {}, 4 : {}, 5 : {}, 6 : {}}
-            if day not in self.contacts_by_day[person]:
-                self.contacts_by_day[person][day] = {}
-            self.agents[person][id] = True
-            self.contacts_by_day[person][day][id] = True
-    def present(self,person):
-        if person not in self.agents:
+        self.registered_people.extend(persobj)
+        self.registered_contexts.extend(array.array('l',[id]) * len(persobj))
+        self.registered_days.extend(array.array('l',[day]) * len(persobj))
+    def _register_week(self,persobj,id):
+        # For contexts that meet every day
+        self._register(persobj,id,-1)
+    def _set_attendance(self,person,state):
+        if len(self.contexts_of(person)) == 0 or not self.attendance.set_state(person,state):
             return False
-        for id in self.agents[person]:
-            self.simplecontacts[id].present(person)
+        # Trackers pick journal entries up the next time their context changes day
+        for index in self.attendance.memberships_of(person):
+            self.memberships[index].record(person,state)
+        return True
+    def present(self,person):
+        return self._set_attendance(person,1)
     def absent(self,person):
-        if person not in self.agents:
+        return self._set_attendance(person,0)
+    def _set_attendance_many(self,persons,state):
+        # Groups the changes by membership so each is journaled, and later applied by
+        # its trackers, once for the whole group
+        groups = {}
+        for person in persons:
+            if len(self.contexts_of(person)) == 0 or not self.attendance.set_state(person,state):
+                continue
+            for index in self.attendance.memberships_of(person):
+                if index not in groups:
+                    groups[index] = []
+                groups[index].append(person)
+        for index,group in groups.items():
+            self.memberships[index].record_many(group,state)
+    def present_many(self,persons):
+        return self._set_attendance_many(persons,1)
+    def absent_many(self,persons):
+        return self._set_attendance_many(persons,0)
+    def set_seed(self,seed):
+        # Every context then draws from streams keyed by (seed,context,day,person);
+        # the alias tables mix contexts in one stream, so they are switched off
+        self.alias_tables = None
+        for context in self.simplecontacts.values():
+            context.seed = seed
+    def enable_alias_tables(self):
+        # Same-day transmit queries then make one Poisson draw for all of a person's
+        # contexts and split it among them with an alias table
+        if self.alias_tables is None and all(context.seed is None for context in self.simplecontacts.values()):
+            self.alias_tables = {}
+    def _alias_table(self,person,weekday,contexts):
+        # Rebuilt only once a context's rate has changed since the table was made
+        versions = tuple(context.rate_version for context in contexts)
+        table = self.alias_tables.get(7 * person + weekday)
+        if table is None or table[0] != versions:
+            table = (versions,probtools.AliasTable([context.transmit_rate(person) for context in contexts]))
+            self.alias_tables[7 * person + weekday] = table
+        return table[1]
+    def _query_transmit_alias(self,person,into):
+        contexts = []
+        for contactid in self.contexts_on(person,self.day % 7):
+            context = self.simplecontacts[contactid]
+            if isinstance(context,SimpleContact):
+                context._select_day(self.day)
+                contexts.append(context)
+            else:
+                context.query_transmit(person,self.day,into)
+        if len(contexts) == 0:
+            return into
+        # Each context thins its share of the proposals down to who is still available
+        table = self._alias_table(person,self.day % 7,contexts)
+        proposals = [0] * len(contexts)
+        for count in range(probtools.draw(table.total)):
+            proposals[table.draw()] += 1
+        for context,count in zip(contexts,proposals):
+            into.merge(context._realize_transmit(person,count))
+        return into
+    def query_transmit(self,person,offsetday = 0,into=None):
+        if into is None:
+            into = ContactAccumulator()
+        if self.alias_tables is not None and offsetday == 0:
+            return self._query_transmit_alias(person,into)
+        for contactid in self.contexts_on(person,(self.day + offsetday) % 7):
+            self.simplecontacts[contactid].query_transmit(person,self.day + offsetday,into)
+        return into
+    def query_receive(self,person,offsetday = 0,into=None):
+        if into is None:
+            into = ContactAccumulator()
+        for contactid in self.contexts_on(person,(self.day + offsetday) % 7):
+            self.simplecontacts[contactid].query_receive(person,self.day + offsetday,into)
+        return into
+    def _query_many(self,persons,offsetday,transmit):
+        # Each context answers for all of the persons it holds on the day in one call
+        day = self.day + offsetday
+        groups = {}
+        for person in dict.fromkeys(persons):
+            for contactid in self.contexts_on(person,day % 7):
+                if contactid not in groups:
+                    groups[contactid] = []
+                groups[contactid].append(person)
+        answered = {} # person -> their events from each context
+        for contactid,group in groups.items():
+            if transmit:
+                answers = self.simplecontacts[contactid].query_transmit_many(group,day)
+            else:
+                answers = self.simplecontacts[contactid].query_contacts_many(group,day)
+            for person,events in zip(group,answers):
+                if person not in answered:
+                    answered[person] = [events]
+                else:
+                    answered[person].append(events)
+        def answer(person,into):
+            for events in answered.get(person,()):
+                into.merge(events)
+        return contact_rows(persons,answer)
+    def query_transmit_many(self,persons,offsetday = 0):
+        if self.alias_tables is not None and offsetday == 0:
+            return contact_rows(persons,self._query_transmit_alias)
+        return self._query_many(persons,offsetday,True)
+    def query_contacts_many(self,persons,offsetday = 0):
+        return self._query_many(persons,offsetday,False)
+    def query_contacts(self,person,offsetday = 0,into=None):
+        if into is None:
+            into = ContactAccumulator()
+        for contactid in self.contexts_on(person,(self.day + offsetday) % 7):
+            self.simplecontacts[contactid].query_contacts(person,self.day + offsetday,into)
+        return into
+
+
+
+class IncidenceContact(object):
+    # Alternative backend built from a finalized CompoundContact. Contexts drawing on the
+    # same memberships become one column of a sparse person x context incidence matrix,
+    # with a daily rate per weekday (zero on days it does not meet). Attendance lives in a
+    # single roster, and partners are drawn over all of a column's slots and thinned
+    # against it, so no per-context tracker state is kept. The sparse and permanent
+    # layers are still asked directly.
+    def __init__(self,compound):
+        compound.finalize()
+        self.day = compound.day
+        self.target = compound.target
+        self.retention_days = compound.retention_days
+        self.attendance = compound.attendance
+        self.layers = compound.roster_contexts
+        self.memberships = compound.memberships
+        membership_index = {}
+        for index,membership in enumerate(self.memberships):
+            membership_index[id(membership)] = index
+        # Columns: one per (transmitters,receivers,distancing,traceable) combination
+        self.rates = []
+        self.transmit_side = []
+        self.receive_side = []
+        self.distanced = []
+        self.traceable = []
+        columns = {}
+        person_columns = {}
+        for context in compound.simplecontacts.values():
+            if not isinstance(context,SimpleContact):
+                continue
+            transmitters = context.transmit_membership
+            receivers = context.receive_membership
+            key = (id(transmitters),id(receivers),context.social_distance_enabled,context.traceable)
+            if key not in columns:
+                column = len(self.rates)
+                columns[key] = column
+                self.rates.append([0.0] * 7)
+                self.transmit_side.append(membership_index[id(transmitters)])
+                self.receive_side.append(membership_index[id(receivers)])
+                self.distanced.append(context.social_distance_enabled)
+                self.traceable.append(context.traceable)
+                for side,membership in ((0,transmitters),(1,receivers)):
+                    for person in membership.positions:
+                        if person not in person_columns:
+                            person_columns[person] = {}
+                        if column not in person_columns[person]:
+                            person_columns[person][column] = [0,0]
+                        person_columns[person][column][side] = membership.weight(person)
+            # Two contexts meeting on the same day with the same people superpose
+            self.rates[columns[key]][context.day % 7] += context.rate_factor
+        # Rows: the columns of person are row_columns[row_offsets[person]:row_offsets[person+1]],
+        # with their transmitter and receiver multiplicities alongside
+        self.row_offsets = array.array('l',[0])
+        self.row_columns = array.array('l')
+        self.row_transmit = array.array('l')
+        self.row_receive = array.array('l')
+        for person in range(compound.population):
+            if person in person_columns:
+                for column,(transmit,receive) in sorted(person_columns[person].items()):
+                    self.row_columns.append(column)
+                    self.row_transmit.append(transmit)
+                    self.row_receive.append(receive)
+            self.row_offsets.append(len(self.row_columns))
+        self.days = {} # day -> column -> realized events and who has been queried
+    def update(self):
+        self.day += 1
+        self.attendance.update()
+        for context in self.layers:
+            context.update()
+        for oldday in [oldday for oldday in self.days if oldday <= self.day - self.retention_days]:
+            del self.days[oldday]
+    def _row(self,person):
+        if person + 1 >= len(self.row_offsets):
+            return range(0)
+        return range(self.row_offsets[person],self.row_offsets[person+1])
+    def present(self,person):
+        return self.attendance.set_state(person,1)
+    def absent(self,person):
+        return self.attendance.set_state(person,0)
+    def present_many(self,persons):
+        for person in persons:
+            self.attendance.set_state(person,1)
+    def absent_many(self,persons):
+        for person in persons:
+            self.attendance.set_state(person,0)
+    def _state(self,column,day):
+        if day not in self.days:
+            self.days[day] = {}
+        states = self.days[day]
+        if column not in states:
+            factor = self.rates[column][day % 7]
+            if self.distanced[column]:
+                # From the day's attendance when first asked about, so later changes
+                # leave it alone whatever the query order
+                factor *= self.attendance.distancing(self.transmit_side[column],self.receive_side[column],day)
+            states[column] = {'factor' : factor, 'transmit' : {}, 'receive' : {}, 'transmitters' : set(), 'receivers' : set()}
+        return states[column]
+    def _realize(self,column,day,side,batch):
+        # Draws the contacts of every (person,weight) in batch from one side of a column;
+        # Poisson counts over all slots, thinned to the people present and not yet
+        # queried from the other side, are exactly the lazy SimpleContact draws
+        state = self._state(column,day)
+        if side == 'transmit':
+            events,other_events,done,their_done,their_side = state['transmit'],state['receive'],state['transmitters'],state['receivers'],self.receive_side[column]
+        else:
+            events,other_events,done,their_done,their_side = state['receive'],state['transmit'],state['receivers'],state['transmitters'],self.transmit_side[column]
+        daydiff = self.day - day
+        poll_absent = self.attendance.roster.poll_absent
+        todo = []
+        for person,weight in batch:
+            if person in done or poll_absent(person,daydiff):
+                continue
+            done.add(person)
+            todo.append((person,weight))
+        if len(todo) == 0:
+            return events
+        membership = self.memberships[their_side]
+        total = membership.total_length()
+        factor = state['factor']
+        if 4 * (total - self.attendance.absent_slots[their_side] - len(their_done)) >= total:
+            pool_weight = total
+            draw = membership.draw
+            eligible = lambda whoitis : whoitis not in their_done and not poll_absent(whoitis,daydiff)
+        else:
+            # Mostly excluded: list who is left and draw from them directly
+            pool = [whoitis for whoitis in membership.people if whoitis not in their_done and not poll_absent(whoitis,daydiff)]
+            weights = [membership.weight(whoitis) for whoitis in pool]
+            pool_weight = sum(weights)
+            draw = lambda count : random.choices(pool,weights=weights,k=count)
+            eligible = lambda whoitis : True
+        counts = [probtools.draw(factor * weight * pool_weight) for person,weight in todo]
+        drawn = draw(sum(counts)) if pool_weight > 0 else []
+        start = 0
+        for (person,weight),count in zip(todo,counts):
+            new_information = {}
+            for whoitis in drawn[start:start+count]:
+                if whoitis != person and eligible(whoitis):
+                    new_information[whoitis] = new_information.get(whoitis,0) + 1
+            start += count
+            for key,value in new_information.items():
+                if key not in other_events:
+                    other_events[key] = {person : value}
+                else:
+                    other_events[key][person] = other_events[key].get(person,0) + value
+            if person not in events:
+                events[person] = new_information
+            else:
+                events[person] = dictionary_sum(events[person],new_information)
+        return events
+    def _query_side(self,side,person,day,into):
+        weekday = day % 7
+        weights = self.row_transmit if side == 'transmit' else self.row_receive
+        for position in self._row(person):
+            column = self.row_columns[position]
+            if weights[position] == 0 or self.rates[column][weekday] == 0:
+                continue
+            events = self._realize(column,day,side,((person,weights[position]),))
+            if person in events:
+                into.merge(events[person])
+        return into
+    def sample_day(self,persons,offsetday=0,sides=('transmit',)):
+        # Realizes the given sides of everyone in persons together, one batch per column
+        # and side; the sparse layers already realize a whole product set per query
+        day = self.day + offsetday
+        weekday = day % 7
+        tracing = 'receive' in sides
+        for side in sides:
+            weights = self.row_transmit if side == 'transmit' else self.row_receive
+            batches = {}
+            for person in persons:
+                for position in self._row(person):
+                    column = self.row_columns[position]
+                    if weights[position] == 0 or self.rates[column][weekday] == 0 or (tracing and not self.traceable[column]):
+                        continue
+                    if column not in batches:
+                        batches[column] = []
+                    batches[column].append((person,weights[position]))
+            for column,batch in batches.items():
+                self._realize(column,day,side,batch)
+    def query_transmit(self,person,offsetday = 0,into=None):
+        if into is None:
+            into = ContactAccumulator()
+        self._query_side('transmit',person,self.day + offsetday,into)
+        for context in self.layers:
+            if person in context.person_data:
+                context.query_transmit(person,self.day + offsetday,into)
+        return into
+    def query_receive(self,person,offsetday = 0,into=None):
+        if into is None:
+            into = ContactAccumulator()
+        self._query_side('receive',person,self.day + offsetday,into)
+        for context in self.layers:
+            if person in context.person_data:
+                context.query_receive(person,self.day + offsetday,into)
+        return into
+    def query_transmit_many(self,persons,offsetday = 0):
+        self.sample_day(persons,offsetday)
+        return contact_rows(persons,lambda person,into : self.query_transmit(person,offsetday,into))
+    def query_contacts_many(self,persons,offsetday = 0):
+        self.sample_day(persons,offsetday,('transmit','receive'))
+        return contact_rows(persons,lambda person,into : self.query_contacts(person,offsetday,into))
+    def query_contacts(self,person,offsetday = 0,into=None):
+        if into is None:
+            into = ContactAccumulator()
+        day = self.day + offsetday
+        weekday = day % 7
+        for position in self._row(person):
+            column = self.row_columns[position]
+            if not self.traceable[column] or self.rates[column][weekday] == 0:
+                continue
+            for side,weights in (('transmit',self.row_transmit),('receive',self.row_receive)):
+                if weights[position] > 0:
+                    events = self._realize(column,day,side,((person,weights[position]),))
+                    if person in events:
+                        into.merge(events[person])
+        for context in self.layers:
+            if person in context.person_data:
+                context.query_contacts(person,day,into)
+        return into
+
+
+
+def world_fingerprint(compound,world_seed=None):
+    # Identifies the world a log was recorded on: its seed, its packed rosters and the
+    # settings the generation options leave on each context (rates, distancing, tracing)
+    compound.finalize()
+    settings = []
+    for contactid in sorted(compound.simplecontacts):
+        context = compound.simplecontacts[contactid]
+        if isinstance(context,SimpleContact):
+            settings.append((context.day,context.rate_factor,context.social_distance_enabled,context.traceable,
+                context.transmit_membership.total_length(),context.receive_membership.total_length()))
+        elif isinstance(context,PermanentContact):
+            settings.append((context.rate,context.pairs))
+        else:
+            settings.append(tuple((dayweight,paircount) for transmitters,receivers,dayweight,paircount in context.pair_data.values()))
+    return array.array('q',[zlib.crc32(str(world_seed).encode()),compound.population,compound.contact_count,
+        zlib.crc32(compound.day_offsets.tobytes()),zlib.crc32(compound.day_contexts.tobytes()),zlib.crc32(repr(settings).encode())])
+
+class ContactLog(object):
+    # Every contact the contexts realized on each day, drawn over all of their members
+    # whatever their attendance (see SimpleContact.realize_day): the contacts of days[k]
+    # are entries day_offsets[k]:day_offsets[k+1] of the columns, entry i being a contact
+    # from transmitters[i] to receivers[i] in context contexts[i] with a uniform mark.
+    # A day's entries are sorted by transmitter, and by_receiver lists them by receiver.
+    # Saved columns have fixed-size typecodes so a log reads back on any platform
+    FINGERPRINT = 6
+    def __init__(self,fingerprint=None):
+        self.fingerprint = fingerprint if fingerprint is not None else array.array('q',[0] * self.FINGERPRINT)
+        self.days = array.array('q')
+        self.day_offsets = array.array('q',[0])
+        self.contexts = array.array('i')
+        self.transmitters = array.array('i')
+        self.receivers = array.array('i')
+        self.marks = array.array('f')
+        self.by_receiver = array.array('i')
+        self.receiver_order = array.array('i') # receivers[by_receiver[i]], to bisect on; not saved
+        self.index = {} # day -> position in days
+    def add_day(self,day,contexts,transmitters,receivers,marks):
+        start = len(self.contexts)
+        order = sorted(range(len(transmitters)),key=transmitters.__getitem__)
+        self.index[day] = len(self.days)
+        self.days.append(day)
+        self.contexts.extend(contexts[entry] for entry in order)
+        self.transmitters.extend(transmitters[entry] for entry in order)
+        self.receivers.extend(receivers[entry] for entry in order)
+        self.marks.extend(marks[entry] for entry in order)
+        self.by_receiver.extend(sorted(range(start,len(self.contexts)),key=self.receivers.__getitem__))
+        self.receiver_order.extend(self.receivers[entry] for entry in self.by_receiver[start:])
+        self.day_offsets.append(len(self.contexts))
+    def entries(self,day):
+        if day not in self.index:
+            return None
+        position = self.index[day]
+        return range(self.day_offsets[position],self.day_offsets[position+1])
+    def transmitted(self,entries,person):
+        # The entries of a day (see entries()) with person as transmitter
+        return range(bisect.bisect_left(self.transmitters,person,entries.start,entries.stop),bisect.bisect_right(self.transmitters,person,entries.start,entries.stop))
+    def received(self,entries,person):
+        start = bisect.bisect_left(self.receiver_order,person,entries.start,entries.stop)
+        stop = bisect.bisect_right(self.receiver_order,person,start,entries.stop)
+        return self.by_receiver[start:stop]
+    def save(self,filename,append=False):
+        # One run per block: the fingerprint, the two column lengths, then the columns themselves
+        with open(filename,'ab' if append else 'wb') as file:
+            self.fingerprint.tofile(file)
+            array.array('q',[len(self.days),len(self.contexts)]).tofile(file)
+            for column in (self.days,self.day_offsets,self.contexts,self.transmitters,self.receivers,self.marks,self.by_receiver):
+                column.tofile(file)
+    def _load(self,file):
+        header = array.array('q')
+        try:
+            header.fromfile(file,self.FINGERPRINT + 2)
+        except EOFError:
             return False
-        for id in self.agents[person]:
-            self.simplecontacts[id].absent(person)
-    def query_transmit(self,person,offsetday = 0):
-        result = {}
-        daymod = (self.day + offsetday) % 7
-        for contactid in self.contacts_by_day[person][daymod]:
-            result = dictionary_sum(result,self.simplecontacts[contactid].query_transmit(person,self.day + offsetday))
-        return result
-    def query_receive(self,person,offsetday = 0):
-        result = {}
-        daymod = (self.day + offsetday) % 7
-        for contactid in self.contacts_by_day[person][daymod]:
-            result = dictionary_sum(result,self.simplecontacts[contactid].query_receive(person,self.day + offsetday))
-        return result
-    def query_contacts(self,person,offsetday = 0):
-        result = {}
-        daymod = (self.day + offsetday) % 7
-        for contactid in self.contacts_by_day[person][daymod]:
-            result = dictionary_sum(result,self.simplecontacts[contactid].query_contacts(person,self.day + offsetday))
-        return result
+        self.fingerprint = header[:self.FINGERPRINT]
+        days,entries = header[self.FINGERPRINT:]
+        self.days.fromfile(file,days)
+        self.day_offsets = array.array('q')
+        self.day_offsets.fromfile(file,days + 1)
+        for column in (self.contexts,self.transmitters,self.receivers,self.marks,self.by_receiver):
+            column.fromfile(file,entries)
+        self.receiver_order.extend(self.receivers[entry] for entry in self.by_receiver)
+        for position,day in enumerate(self.days):
+            self.index[day] = position
+        return True
+
+def read_contact_logs(filename):
+    # Every run saved to filename, in order
+    logs = []
+    with open(filename,'rb') as file:
+        while True:
+            log = ContactLog()
+            if not log._load(file):
+                return logs
+            logs.append(log)
+
+class ContactReplay(object):
+    # Answers queries from the whole days of contacts in a ContactLog, thinned by this
+    # run's attendance: a contact counts when both ends are present that day and, in a
+    # distanced context, its mark is below the day's distancing factor (see Attendance).
+    # Days the log lacks are realized when they begin and added to it, so recording a
+    # run is replaying an empty log. Permanent contexts draw nothing and are asked directly.
+    def __init__(self,compound,log):
+        compound.finalize()
+        self.compound = compound
+        self.log = log
+        self.day = compound.day
+        self.retention_days = compound.retention_days
+        self.target = compound.target
+        self.attendance = compound.attendance
+        self.recorded = set(log.days) # Days that came with the log
+        self.replayed = 0
+        self.sampled = 0
+        membership_index = {}
+        for index,membership in enumerate(compound.memberships):
+            membership_index[id(membership)] = index
+        self.drawn = {} # weekday -> contexts meeting then, by id
+        self.permanent = {}
+        self.traceable = {}
+        self.distanced = {} # Distanced context -> (transmit membership,receive membership)
+        for contactid,context in compound.simplecontacts.items():
+            if isinstance(context,PermanentContact):
+                self.permanent[contactid] = context
+                continue
+            if isinstance(context,SimpleContact):
+                weekdays = [context.day % 7]
+                self.traceable[contactid] = context.traceable
+                if context.social_distance_enabled:
+                    self.distanced[contactid] = (membership_index[id(context.transmit_membership)],membership_index[id(context.receive_membership)])
+            else:
+                weekdays = range(7)
+                self.traceable[contactid] = True
+            for weekday in weekdays:
+                if weekday not in self.drawn:
+                    self.drawn[weekday] = {}
+                self.drawn[weekday][contactid] = context
+        self.factors = {} # day -> distanced context -> fraction of marks kept
+        # Tracing can look back before the first day, as the live contexts allow
+        for day in range(self.day - self.retention_days + 1,self.day):
+            self._realize(day)
+        self._begin_day()
+    def _begin_day(self):
+        for oldday in [oldday for oldday in self.factors if oldday <= self.day - self.retention_days]:
+            del self.factors[oldday]
+        self._realize(self.day)
+    def _realize(self,day):
+        if self.log.entries(day) is not None:
+            return
+        contexts = []
+        transmitters = []
+        receivers = []
+        marks = []
+        for contactid,context in self.drawn.get(day % 7,{}).items():
+            if isinstance(context,SimpleContact):
+                pairs,pairmarks = context.realize_day(day)
+                marks.extend(pairmarks)
+            else:
+                pairs = context.realize_day(day)
+                marks.extend([0.0] * len(pairs))
+            contexts.extend([contactid] * len(pairs))
+            transmitters.extend(source for source,target in pairs)
+            receivers.extend(target for source,target in pairs)
+        self.log.add_day(day,contexts,transmitters,receivers,marks)
+    def update(self):
+        self.day += 1
+        self.compound.update()
+        self._begin_day()
+    def present(self,person):
+        return self.compound.present(person)
+    def absent(self,person):
+        return self.compound.absent(person)
+    def present_many(self,persons):
+        return self.compound.present_many(persons)
+    def absent_many(self,persons):
+        return self.compound.absent_many(persons)
+    def _factor(self,contactid,day):
+        # The distancing factor of a distanced context on day
+        if day not in self.factors:
+            self.factors[day] = {}
+        factors = self.factors[day]
+        if contactid not in factors:
+            transmit,receive = self.distanced[contactid]
+            factors[contactid] = self.attendance.distancing(transmit,receive,day)
+        return factors[contactid]
+    def _answer(self,transmit,person,offsetday,into):
+        day = self.day + offsetday
+        daydiff = -offsetday
+        log = self.log
+        entries = log.entries(day)
+        if entries is not None:
+            if day in self.recorded:
+                self.replayed += 1
+            else:
+                self.sampled += 1
+            poll_absent = self.attendance.roster.poll_absent
+            if not poll_absent(person,daydiff):
+                found = [(entry,log.receivers[entry]) for entry in log.transmitted(entries,person)]
+                if not transmit:
+                    found = [(entry,other) for entry,other in found if self.traceable[log.contexts[entry]]]
+                    found.extend((entry,log.transmitters[entry]) for entry in log.received(entries,person) if self.traceable[log.contexts[entry]])
+                distanced = self.distanced
+                for entry,other in found:
+                    contactid = log.contexts[entry]
+                    if contactid in distanced and log.marks[entry] >= self._factor(contactid,day):
+                        continue
+                    if not poll_absent(other,daydiff):
+                        into.add(other)
+        for contactid in self.compound.contexts_on(person,day % 7):
+            if contactid in self.permanent:
+                if transmit:
+                    self.permanent[contactid].query_transmit(person,day,into)
+                else:
+                    self.permanent[contactid].query_contacts(person,day,into)
+        return into
+    def query_transmit(self,person,offsetday = 0,into=None):
+        return self._answer(True,person,offsetday,ContactAccumulator() if into is None else into)
+    def query_contacts(self,person,offsetday = 0,into=None):
+        return self._answer(False,person,offsetday,ContactAccumulator() if into is None else into)
+    def _many(self,transmit,persons,offsetday):
+        return contact_rows(persons,lambda person,into : self._answer(transmit,person,offsetday,into))
+    def query_transmit_many(self,persons,offsetday = 0):
+        return self._many(True,persons,offsetday)
+    def query_contacts_many(self,persons,offsetday = 0):
+        return self._many(False,persons,offsetday)
@@ -0,0 +1,405 @@
+import random
+import ptracker
+
+def transmit_context(transmitters,receivers,rate):
+    context = ptracker.SimpleContact()
+    context.add_transmitters(list(range(transmitters)))
+    context.add_receivers(list(range(transmitters,transmitters+receivers)))
+    context.set_rate(rate)
+    return context
+
+def contacts_per_day(answers_on,days):
+    total = 0
+    for day in range(days):
+        total += sum(sum(answer.values()) for answer in answers_on(day))
+    return total / days
+
+def test_batch_transmit_matches_single_queries():
+    # 100 transmitters onto 20 receivers at rate 0.02 expect 40 contacts a day either way
+    days = 300
+    random.seed(1)
+    context = transmit_context(100,20,0.02)
+    single = contacts_per_day(lambda day : [context.query_transmit(person,day) for person in range(100)],days)
+    random.seed(2)
+    context = transmit_context(100,20,0.02)
+    batch = contacts_per_day(lambda day : context.query_transmit_many(list(range(100)),day),days)
+    assert abs(single - 40) < 2
+    assert abs(batch - 40) < 2
+
+def test_batch_contacts_match_single_queries():
+    # 20 members at rate 0.05 draw 19 pairs a day, 38 contacts counted from both ends,
+    # whether the day is current or already past
+    days = 300
+    for past in (False,True):
+        for batch,seed in ((False,1),(True,2)):
+            random.seed(seed)
+            context = ptracker.SimpleContact()
+            context.add_members(list(range(20)))
+            context.set_rate(0.05)
+            def answers_on(day):
+                if past:
+                    context.query_transmit(0,day + 1)
+                if batch:
+                    return context.query_contacts_many(list(range(20)),day)
+                return [context.query_contacts(person,day) for person in range(20)]
+            assert abs(contacts_per_day(answers_on,days) - 38) < 2
+
+def test_contact_rows_share_one_scratch_accumulator():
+    contacts = {1 : {2 : 1, 3 : 2}, 5 : {1 : 1}}
+    scratches = []
+    def answer(person,into):
+        scratches.append(into)
+        into.merge(contacts.get(person,{}))
+    offsets,ids,strengths = ptracker.contact_rows([1,4,1,5],answer)
+    assert list(offsets) == [0,2,2,4,5]
+    assert list(ids) == [2,3,2,3,1] and list(strengths) == [1,2,1,2,1]
+    # Asked once per person, always with the same accumulator
+    assert len(scratches) == 3 and all(scratch is scratches[0] for scratch in scratches)
+
+def test_transmit_queries_exhaust_the_day():
+    # Past half of the transmitters queried one at a time, the rest of the day is drawn at once
+    context = transmit_context(10,10,0.1)
+    exhausted = []
+    exhaust = context.exhaust
+    context.exhaust = lambda : exhausted.append(True) or exhaust()
+    for person in range(5):
+        context.query_transmit(person,0)
+    assert exhausted == []
+    context.query_transmit(5,0)
+    assert exhausted == [True]
+    assert all(context.transmitters.get_state(person) == 0 for person in range(10))
+
+def test_batch_queries_exhaust_the_day():
+    # The same threshold counted over batches: five of the ten transmitters leave the
+    # day open, a sixth in the next batch draws the rest of it at once
+    context = transmit_context(10,10,0.1)
+    exhausted = []
+    exhaust = context.exhaust
+    context.exhaust = lambda : exhausted.append(True) or exhaust()
+    context.query_contacts_many(list(range(5)),0)
+    assert exhausted == []
+    context.query_contacts_many([5,15],0)
+    assert exhausted == [True]
+    assert all(context.transmitters.get_state(person) == 0 for person in range(10))
+    assert all(context.receivers.get_state(person) == 0 for person in range(10,20))
+
+def test_past_day_keeps_its_own_absences():
+    # A day the context never reached is answered with who was away that day, not today
+    compound = ptracker.CompoundContact(10)
+    context = compound.new_context(0)
+    context.add_members(list(range(10)))
+    context.set_rate(1.0)
+    compound.finalize()
+    compound.absent(3)
+    compound.update()
+    compound.present(3)
+    compound.absent(5)
+    for day in range(6):
+        compound.update()
+    assert len(compound.query_contacts(3,-7)) == 0
+    contacts = compound.query_contacts(5,-7)
+    assert len(contacts) > 0 and 3 not in contacts
+
+def test_quiet_contexts_drop_expired_days():
+    compound = ptracker.CompoundContact(3)
+    context = compound.new_context(0)
+    context.add_members(list(range(10)))
+    context.set_rate(1.0)
+    compound.finalize()
+    compound.update()
+    # Tracing back a day the context met on, then never asking it again
+    assert len(compound.query_contacts(0,-1)) > 0
+    assert list(context.history) == [0]
+    compound.update()
+    assert list(context.history) == [0]
+    compound.update()
+    assert context.history == {} and len(compound.remembering) == 0
+
+def test_incidence_distancing_fixed_at_the_first_query():
+    compound = ptracker.CompoundContact(3)
+    context = compound.new_context(1)
+    context.add_members(list(range(10)))
+    context.set_rate(0.1)
+    context.social_distance_enabled = True
+    incidence = ptracker.IncidenceContact(compound)
+    incidence.absent(0)
+    incidence.update()
+    # The day's departures count until the day is first queried, and not after
+    incidence.absent(1)
+    incidence.query_transmit(2)
+    incidence.absent(3)
+    incidence.query_transmit(4)
+    assert abs(incidence.days[1][0]['factor'] - 0.08) < 1e-12
+
+def distanced_world():
+    compound = ptracker.CompoundContact(3)
+    context = compound.new_context(1)
+    context.add_members(list(range(100)))
+    context.set_rate(0.04)
+    context.social_distance_enabled = True
+    compound.finalize()
+    return compound
+
+def departures_then_transmit(backend):
+    # The order Disease uses: the day begins, the day's departures, then the transmit batch
+    backend.update()
+    backend.absent_many(list(range(50)))
+    offsets,ids,strengths = backend.query_transmit_many(list(range(50,100)))
+    return sum(strengths)
+
+def test_backends_agree_on_same_day_departures():
+    # 50 present at half the rate over 50 receivers: 50 * 0.04 * 0.5 * 49 = 49 contacts
+    trials = 200
+    random.seed(5)
+    compound = sum(departures_then_transmit(distanced_world()) for trial in range(trials)) / trials
+    incidence = sum(departures_then_transmit(ptracker.IncidenceContact(distanced_world())) for trial in range(trials)) / trials
+    assert abs(compound - 49) < 3
+    assert abs(incidence - 49) < 3
+
+def attendance_world():
+    compound = ptracker.CompoundContact(3)
+    first = compound.new_context(0)
+    first.add_members(list(range(40)))
+    first.set_rate(0.1)
+    second = compound.new_context(-1)
+    second.add_transmitters(list(range(20,60)))
+    second.add_receivers(list(range(30)))
+    second.set_rate(0.05)
+    compound.finalize()
+    return compound
+
+def contacts_after_changes(backend,bulk):
+    # Overlapping departures and returns, repeats and a person with no contexts
+    answers = []
+    for day in range(4):
+        back = list(range(7*day-7,7*day))
+        away = list(range(7*day,7*day+15)) + [7*day,100]
+        if bulk:
+            backend.present_many(back)
+            backend.absent_many(away)
+        else:
+            for person in back:
+                backend.present(person)
+            for person in away:
+                backend.absent(person)
+        answers.append([dict(backend.query_contacts(person)) for person in range(60)])
+        backend.update()
+    return answers
+
+def test_bulk_attendance_matches_single_changes():
+    for incidence in (False,True):
+        runs = []
+        for bulk in (False,True):
+            random.seed(3)
+            backend = attendance_world()
+            if incidence:
+                backend = ptracker.IncidenceContact(backend)
+            runs.append(contacts_after_changes(backend,bulk))
+        assert runs[0] == runs[1]
+
+def test_alias_tables_keep_the_rates():
+    # Per transmitter: 10 present receivers at 0.05, 10 at 0.1 and 9 present fellow
+    # members at 0.02 expect 0.5, 1.0 and 0.18 contacts a day, one draw split or not
+    days = 500
+    for alias in (False,True):
+        random.seed(4)
+        compound = ptracker.CompoundContact(3)
+        first = compound.new_context(-1)
+        first.add_transmitters(list(range(10)))
+        first.add_receivers(list(range(10,30)))
+        first.set_rate(0.05)
+        second = compound.new_context(-1)
+        second.add_transmitters(list(range(10)))
+        second.add_receivers(list(range(30,40)))
+        second.set_rate(0.1)
+        third = compound.new_context(-1)
+        third.add_members(list(range(20)))
+        third.set_rate(0.02)
+        compound.finalize()
+        compound.absent_many(list(range(10,20)))
+        if alias:
+            compound.enable_alias_tables()
+            assert compound.alias_tables is not None
+        totals = [0,0,0]
+        for day in range(days):
+            for person in range(10):
+                for contact,strength in compound.query_transmit(person).items():
+                    totals[0 if contact < 10 else 1 if contact < 30 else 2] += strength
+            compound.update()
+        for total,expected in zip(totals,(0.18,0.5,1.0)):
+            assert abs(total / days / 10 - expected) < 0.05
+
+def test_permanent_pairs_are_looked_up():
+    # Every pair meets daily, once per product set joining it, less whoever was away that day
+    context = ptracker.PermanentContact()
+    context.add_product_set([0,1],[1,2],1)
+    context.add_product_set([1],[2,3],1)
+    assert dict(context.query_transmit(1,0)) == {2 : 2, 3 : 1}
+    assert dict(context.query_receive(2,0)) == {0 : 1, 1 : 2}
+    assert dict(context.query_contacts(1,0)) == {0 : 1, 2 : 2, 3 : 1}
+    context.absent(2)
+    context.update()
+    context.present(2)
+    context.absent(0)
+    assert dict(context.query_contacts(1,0)) == {0 : 1, 3 : 1}
+    assert dict(context.query_contacts(1,1)) == {2 : 2, 3 : 1}
+    assert len(context.query_transmit(2,0)) == 0 and len(context.execution_data) == 0
+
+def test_shared_membership_is_copied_on_write():
+    compound = ptracker.CompoundContact()
+    first = compound.new_context(0)
+    first.add_members(list(range(5)))
+    second = compound.new_context(1,like=first)
+    assert second.transmit_membership is first.transmit_membership
+    second.add_members([7])
+    assert 7 not in first.members() and 7 in second.members()
+    first.add_transmitters([8])
+    assert 8 not in second.members()
+    assert 8 in first.transmit_membership.positions and 8 not in first.receive_membership.positions
+    assert sorted(second.members()) == [0,1,2,3,4,7]
+
+def test_weighted_members_are_drawn_by_weight():
+    membership = ptracker.Membership()
+    membership.add({0 : 3, 1 : 1, 2 : 1, 3 : 5})
+    assert membership.people == [0,1,2,3] and membership.total_length() == 10
+    tracker = ptracker.PersonTracker(membership)
+    random.seed(3)
+    drawn = tracker.sample(20000)
+    assert abs(drawn.count(3) / 20000 - 0.5) < 0.02
+    # Half the weight off switches the tracker to its partition
+    tracker.set_state(3,0)
+    tracker.activate()
+    assert not tracker.thinning and tracker.active_length() == 5
+    drawn = tracker.sample(20000)
+    assert 3 not in drawn and abs(drawn.count(0) / 20000 - 0.6) < 0.02
+
+def replay_world():
+    compound = ptracker.CompoundContact(3)
+    context = compound.new_context(0)
+    context.add_members(list(range(20)))
+    context.set_rate(0.5)
+    compound.finalize()
+    return compound
+
+def test_replay_is_not_thinned_by_the_recording_run():
+    random.seed(4)
+    log = ptracker.ContactLog()
+    recording = ptracker.ContactReplay(replay_world(),log)
+    recording.absent(5)
+    assert 5 not in recording.query_contacts(6)
+    replay = ptracker.ContactReplay(replay_world(),log)
+    replay.absent(9)
+    # Present here, 5 gets the contacts the recording run drew for them
+    assert len(replay.query_contacts(5)) > 0
+    replayed = dict(replay.query_contacts(6).items())
+    assert 5 in replayed and 9 not in replayed
+    del replayed[5]
+    assert replayed == {person : count for person,count in recording.query_contacts(6).items() if person != 9}
+    assert replay.replayed == 2 and replay.sampled == 0
+
+def test_replay_distancing_matches_the_compound_run():
+    # A recording replay of the world in test_backends_agree_on_same_day_departures
+    trials = 200
+    random.seed(6)
+    replay = sum(departures_then_transmit(ptracker.ContactReplay(distanced_world(),ptracker.ContactLog())) for trial in range(trials)) / trials
+    assert abs(replay - 49) < 3
+
+def test_contact_log_reads_back(tmp_path):
+    log = ptracker.ContactLog(ptracker.world_fingerprint(replay_world(),5))
+    log.add_day(3,[0,0,1,1],[4,2,4,7],[5,5,2,4],[0.5,0.25,0.75,0.125])
+    path = str(tmp_path / 'contacts.log')
+    log.save(path)
+    log.save(path,True)
+    logs = ptracker.read_contact_logs(path)
+    assert len(logs) == 2 and all(loaded.fingerprint == log.fingerprint for loaded in logs)
+    # 8 bytes a column entry whatever the platform's long
+    assert logs[0].days.itemsize == 8 and logs[0].day_offsets.itemsize == 8
+    entries = logs[1].entries(3)
+    assert sorted(logs[1].receivers[entry] for entry in logs[1].transmitted(entries,4)) == [2,5]
+    assert sorted(logs[1].transmitters[entry] for entry in logs[1].received(entries,5)) == [2,4]
+    assert sorted(logs[1].marks[entry] for entry in logs[1].received(entries,2)) == [0.75]
+
+def test_world_fingerprint_tells_worlds_apart():
+    fingerprint = ptracker.world_fingerprint(replay_world(),5)
+    assert ptracker.world_fingerprint(replay_world(),5) == fingerprint
+    assert ptracker.world_fingerprint(replay_world(),6)[0] != fingerprint[0]
+    other = ptracker.CompoundContact(3)
+    other.new_context(1).add_members(list(range(20)))
+    assert ptracker.world_fingerprint(other,5)[1:] != fingerprint[1:]
+    # The same rosters with another rate or distancing are another world too
+    faster = replay_world()
+    faster.simplecontacts[0].set_rate(0.6)
+    assert ptracker.world_fingerprint(faster,5) != fingerprint
+    distanced = replay_world()
+    distanced.simplecontacts[0].social_distance_enabled = True
+    assert ptracker.world_fingerprint(distanced,5) != fingerprint
+
+def test_replay_rejects_other_generation_options(tmp_path):
+    import worldbuilder2
+    path = str(tmp_path / 'contacts.log')
+    recording = worldbuilder2.University({'world_seed' : 5, 'contact_record' : path})
+    recording.generate()
+    recording.end_run()
+    worldbuilder2.University({'world_seed' : 5, 'contact_replay' : path}).generate()
+    other = worldbuilder2.University({'world_seed' : 5, 'contact_replay' : path, 'academic_contacts' : 40,
+        'social_distancing' : False, 'broad_social_contacts' : 20})
+    try:
+        other.generate()
+    except Exception as error:
+        assert 'different world' in str(error)
+    else:
+        assert False, 'replayed a log recorded with other options'
+
+def test_keyed_streams_repeat_and_stay_apart():
+    key = ptracker.stream_key(7,3,5)
+    first = ptracker.KeyedStream(key,11)
+    again = ptracker.KeyedStream(key,11)
+    draws = [first.random() for index in range(1000)]
+    assert draws == [again.random() for index in range(1000)]
+    assert all(0 <= value < 1 for value in draws) and abs(sum(draws) / 1000 - 0.5) < 0.05
+    assert ptracker.KeyedStream(key,12).random() != draws[0]
+    assert ptracker.stream_key(7,3,5) == key and ptracker.stream_key(7,3,6) != key
+
+def keyed_answers(persons,seed):
+    # Transmit and receive each day, then contacts two days back, under another global seed
+    random.seed(seed)
+    compound = ptracker.CompoundContact(3)
+    first = compound.new_context(-1)
+    first.add_members(list(range(30)))
+    first.set_rate(0.1)
+    second = compound.new_context(-1)
+    second.add_transmitters(list(range(20,40)))
+    second.add_receivers(list(range(30)))
+    second.set_rate(0.05)
+    sparse = compound.new_sparse()
+    sparse.add_product_set(list(range(10)),list(range(5,15)),[0.3] * 7)
+    compound.finalize()
+    compound.set_seed(7)
+    compound.absent(3)
+    answers = {}
+    for day in range(3):
+        for person in persons:
+            answers[(day,'transmit',person)] = dict(compound.query_transmit(person))
+            answers[(day,'receive',person)] = dict(compound.query_receive(person))
+        compound.update()
+    for person in persons:
+        answers[('past',person)] = dict(compound.query_contacts(person,-2))
+    return answers
+
+def test_keyed_draws_ignore_query_order_and_subset():
+    everyone = keyed_answers(list(range(40)),1)
+    some = keyed_answers(list(range(39,0,-3)),2)
+    assert sum(len(answer) for answer in everyone.values()) > 0
+    assert all(everyone[query] == answer for query,answer in some.items())
+
+def test_generate_rejects_options_it_cannot_honor():
+    import worldbuilder2
+    for options,name in (({'contact_backend' : 'incidence', 'contact_seed' : 7},'contact_seed'),
+            ({'contact_backend' : 'incidence', 'contact_alias_tables' : True},'contact_alias_tables'),
+            ({'contact_backend' : 'incidnce'},'contact_backend')):
+        try:
+            worldbuilder2.University(options).generate()
+        except ValueError as error:
+            assert name in str(error)
+        else:
+            assert False, '%s ignored' % name
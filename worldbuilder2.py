@@ -18,6 +18,8 @@ import probtools
 import universal
 import random
 import math
+import bisect
+import collections
 import ptracker
 
 def get_parameter(optionsdict,parameter,default):
@@ -87,6 +89,15 @@ class University(object):
         self.online_transition = get_parameter(optionsdict,'online_transition',30)
         self.residential_rate = 1
         self.social_distancing = get_parameter(optionsdict,'social_distancing', True)
+        self.retention_days = get_parameter(optionsdict,'contact_tracing_days',2) + 1 # Today plus every day contact tracing looks back
+        self.contact_backend = get_parameter(optionsdict,'contact_backend','compound') # 'compound' or 'incidence'
+        self.contact_alias_tables = get_parameter(optionsdict,'contact_alias_tables',False) # Compound backend only
+        self.contact_seed = get_parameter(optionsdict,'contact_seed',None) # Compound backend only: contacts independent of query order
+        self.world_seed = get_parameter(optionsdict,'world_seed',None) # Same world on every generate(), e.g. to replay contacts
+        self.contact_record = get_parameter(optionsdict,'contact_record',None) # File each run's realized contacts are saved to
+        self.contact_replay = get_parameter(optionsdict,'contact_replay',None) # File of recorded runs to serve contacts from
+        self.replay_logs = None
+        self.runs = 0
         #if self.online_transition is not False:
             #default_of = 0.5 * (1.0 + self.online_transition / self.maximum_section_size)
         #else:
@@ -305,6 +316,15 @@ class University(object):
         self.fastsubsets = probtools.FastSubsets(5)
 
     def generate(self):
+        if self.contact_backend not in ('compound','incidence'):
+            raise ValueError("unknown contact_backend %r; use 'compound' or 'incidence'" % (self.contact_backend,))
+        if self.contact_backend == 'incidence' and self.contact_alias_tables:
+            raise ValueError('contact_alias_tables needs the compound contact backend; the incidence backend has no alias tables')
+        if self.contact_backend == 'incidence' and self.contact_seed is not None:
+            raise ValueError('contact_seed needs the compound contact backend; the incidence backend draws no keyed streams')
+        if self.world_seed is not None:
+            outside_state = random.getstate()
+            random.seed(self.world_seed)
         if self.verbose:
             print('===== University Generation: Student Scheduler')
         self.assign_students()
@@ -331,7 +351,7 @@ class University(object):
         self.spatiotemporal()
         if self.verbose:
             print('===== University Generation: Academic Contacts')
-        self.compoundcontact = ptracker.CompoundContact()
+        self.compoundcontact = ptracker.CompoundContact(self.retention_days)
         self.register_academic_contacts(daily_contacts=self.academic_contacts)
         if self.test:
             self.compoundcontact._test(14)
@@ -355,6 +375,36 @@ class University(object):
         self.register_residential_contacts(residential_neighbors=self.residential_neighbors)
         if self.test:
             self.compoundcontact._test(14)
+        self.compoundcontact.finalize()
+        if self.contact_record is not None or self.contact_replay is not None:
+            # Contacts come from whole logged days thinned to attendance, so the backend
+            # and alias table options do not apply
+            if self.contact_seed is not None:
+                self.compoundcontact.set_seed(self.contact_seed)
+            fingerprint = ptracker.world_fingerprint(self.compoundcontact,self.world_seed)
+            if self.contact_record is not None:
+                self.contact_log = ptracker.ContactLog(fingerprint)
+            else:
+                # Run k replays the k-th recorded run
+                if self.replay_logs is None:
+                    self.replay_logs = ptracker.read_contact_logs(self.contact_replay)
+                if len(self.replay_logs) == 0:
+                    raise Exception('contact_replay file %s holds no recorded runs' % self.contact_replay)
+                self.contact_log = self.replay_logs[self.runs % len(self.replay_logs)]
+                if self.contact_log.fingerprint[0] != fingerprint[0]:
+                    raise Exception('contact_replay file %s was recorded with a different world_seed than %s' % (self.contact_replay,self.world_seed))
+                if self.contact_log.fingerprint != fingerprint:
+                    raise Exception('contact_replay file %s was recorded on a different world; replay with the world_seed and options it was recorded with' % self.contact_replay)
+            self.compoundcontact = ptracker.ContactReplay(self.compoundcontact,self.contact_log)
+        elif self.contact_backend == 'incidence':
+            self.compoundcontact = ptracker.IncidenceContact(self.compoundcontact)
+        elif self.contact_seed is not None:
+            self.compoundcontact.set_seed(self.contact_seed)
+        elif self.contact_alias_tables:
+            self.compoundcontact.enable_alias_tables()
+        self.runs += 1
+        if self.world_seed is not None:
+            random.setstate(outside_state)
         self.classes = len(self.class_data)
 
 
@@ -384,12 +434,20 @@ class University(object):
                 del self.close_contacts[person]
     def update_query_system(self):
         self.compoundcontact.update()
-    def query_transmit(self,person):
-        result = self.compoundcontact.query_transmit(person)
+    def end_run(self):
+        if self.contact_record is not None:
+            self.contact_log.save(self.contact_record,self.runs > 1)
+    def query_transmit(self,person,into=None):
+        result = self.compoundcontact.query_transmit(person,0,into)
         return result
-    def query_contacts(self,person,daysback):
-        result = self.compoundcontact.query_contacts(person,daysback)
+    def query_contacts(self,person,daysback,into=None):
+        result = self.compoundcontact.query_contacts(person,daysback,into)
         return result
+    def query_transmit_many(self,persons):
+        # Compressed rows (offsets,contact ids,strengths), one row per entry of persons
+        return self.compoundcontact.query_transmit_many(persons,0)
+    def query_contacts_many(self,persons,daysback):
+        return self.compoundcontact.query_contacts_many(persons,daysback)
     def register_departure(self,person):
         self.compoundcontact.absent(person)
         if person not in self.absent:
@@ -415,6 +473,34 @@ class University(object):
             self.class_data[classno]['attendance'] = new_triple
             self._attendance_bin_me(old_triple,new_triple)
 
+    def register_departures(self,persons):
+        # Same as register_departure for each person, with every context and class updated once
+        self.compoundcontact.absent_many(persons)
+        self._shift_attendance(persons,-1)
+    def register_returns(self,persons):
+        self.compoundcontact.present_many(persons)
+        self._shift_attendance(persons,1)
+    def _shift_attendance(self,persons,change):
+        moves = {}
+        for person in persons:
+            if change < 0:
+                self.absent[person] = True
+            elif person in self.absent:
+                del self.absent[person]
+            if person not in self.student_data:
+                continue
+            for classno in self.student_data[person]['classes']:
+                moves[classno] = moves.get(classno,0) + change
+        # The triple after k single moves depends only on k, and binning only on the end points
+        for classno,shift in moves.items():
+            old_triple = self.class_data[classno]['attendance']
+            if shift < 0:
+                new_triple = [min(old_triple[0],old_triple[1]+shift),old_triple[1]+shift,old_triple[2]]
+            else:
+                new_triple = [old_triple[0],old_triple[1]+shift,max(old_triple[2],old_triple[1]+shift)]
+            self.class_data[classno]['attendance'] = new_triple
+            self._attendance_bin_me(old_triple,new_triple)
+
     def take_attendance(self):
         self.attendance_counts = []
         for index in range(len(self.attendance_bins)):
@@ -480,7 +566,8 @@ class University(object):
                     self.student_data[person]['schedule'][day].append(deptid)
         for department in self.department_data:
             self.department_data[department]['schedule'] = {0 : {}, 1: {}, 2: {}, 3 : {}, 4 : {}, 5 : {}, 6 : {}}
-            self.department_data[department]['around_today'] = {0 : [], 1 : [], 2 : [], 3 : [], 4 : [], 5 : [], 6 : []}
+            # Weighted rosters: person -> number of their in-person classes here that day
+            around_today = {day : collections.Counter() for day in range(7)}
             for classid in self.department_data[department]['classes']:
                 if len(self.class_data[classid]['students']) < self.online_transition:
                     daylist = self.class_data[classid]['days']
@@ -489,40 +576,60 @@ class University(object):
                     checkfor = ['students','instructors','assistants']
                     for ptype in checkfor:
                         if ptype in self.class_data[classid]:
-                            for person in self.class_data[classid][ptype]:
-                                for day in daylist:
-                                    self.department_data[department]['around_today'][day].append(person)
+                            for day in daylist:
+                                around_today[day].update(self.class_data[classid][ptype])
+            self.department_data[department]['around_today'] = {day : dict(around) for day,around in around_today.items()}
 
 
     def assign_students(self):
+        # Batched: cohorts and courseloads for everyone at once, then every course cluster
+        # of a cohort in one draw, then class rosters grouped from the flat enrollment list
         self.student_data = {}
         self.class_data = {}
         self.cohort_data = {}
+        students = universal.students
+        cohorts = random.choices(range(universal.class_cohorts),k=students)
+        courseloads = random.choices((4,5),k=students)
+        clusters = [None] * students
         for cohort in range(universal.class_cohorts):
-            self.cohort_data[cohort] = {'students' : []}
-        for index in range(universal.students):
-            self.student_data[index] = {}
-            courseload = random.randint(4,5)
-            cohort = random.randrange(universal.class_cohorts)
-            self.cohort_data[cohort]['students'].append(index)
-            for subindex in range(courseload):
-                chosen = self.selection_engine[cohort].draw()
-                if chosen not in self.student_data[index]:
-                    self.student_data[index][chosen] = 1
-                else:
-                    self.student_data[index][chosen] += 1
-            personal_result = [0]*courseload
-            added = 0
-            for key,value in self.student_data[index].items():
-                for subnumber in self.fastsubsets.draw(value):
-                    courseno = key * 5 + subnumber
-                    personal_result[added] = courseno
-                    added += 1
-                    if courseno not in self.class_data:
-                        self.class_data[courseno] = {'students' : [index]}
-                    else:
-                        self.class_data[courseno]['students'].append(index)
-            self.student_data[index] = { 'cohort' : cohort, 'classes' : personal_result }
+            members = [index for index in range(students) if cohorts[index] == cohort]
+            self.cohort_data[cohort] = {'students' : members}
+            chosen = self.selection_engine[cohort].draw_many(sum(courseloads[index] for index in members))
+            start = 0
+            for index in members:
+                clusters[index] = chosen[start:start+courseloads[index]]
+                start += courseloads[index]
+        # A cluster drawn k times gives k distinct sections out of its 5, drawn in bulk per k
+        pending = []
+        positions = {multiplicity : [] for multiplicity in range(1,6)}
+        for index in range(students):
+            for key in dict.fromkeys(clusters[index]):
+                multiplicity = clusters[index].count(key)
+                positions[multiplicity].append(len(pending))
+                pending.append((index,key * 5))
+        subsets = [None] * len(pending)
+        for multiplicity in positions:
+            for position,subset in zip(positions[multiplicity],self.fastsubsets.draw_many(multiplicity,len(positions[multiplicity]))):
+                subsets[position] = subset
+        enrolled = []
+        courses = []
+        for (index,base),subset in zip(pending,subsets):
+            for subnumber in subset:
+                enrolled.append(index)
+                courses.append(base + subnumber)
+        start = 0
+        for index in range(students):
+            self.student_data[index] = { 'cohort' : cohorts[index], 'classes' : courses[start:start+courseloads[index]] }
+            start += courseloads[index]
+        order = sorted(range(len(courses)),key=courses.__getitem__)
+        start = 0
+        while start < len(order):
+            courseno = courses[order[start]]
+            stop = start
+            while stop < len(order) and courses[order[stop]] == courseno:
+                stop += 1
+            self.class_data[courseno] = {'students' : [enrolled[position] for position in order[start:stop]]}
+            start = stop
 
     def assign_departments(self):
         self.department_data = {}
@@ -561,6 +668,11 @@ class University(object):
         class_studentlist = self.class_data
         department_dutylist = self.department_data
         instructor_assignments = {}
+        # Students ordered by their lowest course number: those who may assist a class
+        # (every course of theirs numbered above it) are a suffix of assistant_pool
+        lowest = [min(student_classlist[person]['classes']) for person in range(universal.students)]
+        assistant_pool = sorted(range(universal.students),key=lowest.__getitem__)
+        lowest_courses = [lowest[person] for person in assistant_pool]
         for department in department_dutylist:
             for person in department_dutylist[department]['instructors']:
                 if person not in instructor_assignments:
@@ -599,10 +711,9 @@ class University(object):
             for index,classname in enumerate(histogram_keys):
                 if 'assistants' not in class_studentlist[classname]:
                     class_studentlist[classname]['assistants'] = []
+                eligible = bisect.bisect_right(lowest_courses,classname)
                 for assistantno in range(assistant_need_histogram[index]):
-                    person = random.randrange(0,universal.students)
-                    while min(student_classlist[person]['classes']) <= classname:
-                        person = random.randrange(0,universal.students)
+                    person = assistant_pool[random.randrange(eligible,universal.students)]
                     class_studentlist[classname]['assistants'].append(person)
                     if 'assistants' not in self.department_data[department]:
                         self.department_data[department]['assistants'] = []
@@ -624,10 +735,9 @@ class University(object):
                 self.class_data[key]['type'] = 'class'
                 self.class_data[key]['days'] = probtools.list_select(universal.meeting_schedules)
         needs_recitations = []
+        rejoined = {} # person -> (plenaries left, sections and recitations joined)
         for key,data in needs_subdivision:
             sections_needed = len(data['instructors'])
-            size_histogram = [int(1+len(data['students'])/sections_needed)] * sections_needed
-            section_sorter = probtools.Histogram(size_histogram)
             section_IDs = list(range(self.sectionID,self.sectionID+sections_needed))
             needs_recitations += section_IDs
             data['sections'] = section_IDs
@@ -659,14 +769,13 @@ class University(object):
                     section_assignment = section_IDs[0]
 
             self.sectionID += sections_needed
-            for index,person in enumerate(data['students']):
-                newsection = section_IDs[section_sorter.draw(1,False)]
-                self.student_data[person]['classes'].remove(key)
-                self.class_data[newsection]['students'].append(person)
-                if 'plenary' not in self.student_data[person]:
-                    self.student_data[person]['plenary'] = []
-                self.student_data[person]['plenary'].append(key)
-                self.student_data[person]['classes'].append(newsection)
+            seats = [int(1+len(data['students'])/sections_needed)] * sections_needed
+            for person,seat in zip(data['students'],probtools.deal(len(data['students']),seats)):
+                self.class_data[section_IDs[seat]]['students'].append(person)
+                if person not in rejoined:
+                    rejoined[person] = ([],[])
+                rejoined[person][0].append(key)
+                rejoined[person][1].append(section_IDs[seat])
             for thissectionID in section_IDs:
                 recitation_groups = probtools.subdivide(self.class_data[thissectionID]['students'],self.recitation_rules[1])
                 self.class_data[thissectionID]['recitations'] = []
@@ -683,10 +792,13 @@ class University(object):
                         self.class_data[self.sectionID]['assistants'].append(myassistant)
                         self.assistant_data[myassistant]['assignments'].append(self.sectionID)
                     for person in group:
-                        self.student_data[person]['classes'].append(self.sectionID)
-                        self.class_data[self.sectionID]['students'].append(person)
+                        rejoined[person][1].append(self.sectionID)
+                    self.class_data[self.sectionID]['students'] = group
                     self.class_data[thissectionID]['recitations'].append(self.sectionID)
                     self.sectionID += 1
+        for person,(plenaries,joined) in rejoined.items():
+            self.student_data[person]['classes'] = [classid for classid in self.student_data[person]['classes'] if classid not in plenaries] + joined
+            self.student_data[person]['plenary'] = plenaries
 
         sum = [0,0,0]
         size = [0,0,0]
@@ -711,30 +823,31 @@ class University(object):
                 meeting_status.append([csize,status,classid])
                 self.class_data[classid]['space_upgrade_factor'] = 1.0
         print('+++++ SD_BEFOR: %6i %8i %10i\n+++++ SD_AFTER: %6i %8i %10i' % (sum[0],size[0],pairs[0],sum[1],size[1],pairs[1]))
+        # The k-th largest class still meeting in person gets the k-th largest room
         meeting_status.sort(reverse=True)
-        unoccupied = 0
-        for item in meeting_status:
-            if item[1] == 1:
-                ratio = 1
-                new_roomsize = meeting_status[unoccupied][0]
-                old_roomsize = item[0]
-                unoccupied += 1
-                if new_roomsize > 1.5 * old_roomsize and new_roomsize >= 20:
-                    if old_roomsize < 10:
-                        old_roomsize = 10
-                    ratio = old_roomsize / new_roomsize
-                    if ratio > 1 or not self.social_distancing:
-                        ratio = 1
-                    self.class_data[item[2]]['space_upgrade_factor'] = ratio
-                    #print(ratio,old_roomsize,new_roomsize)
-                sum[2] += ratio
-                size[2] += item[0] * ratio
-                pairs[2] += item[0] * (item[0]-1) * ratio
+        rooms = [item[0] for item in meeting_status]
+        in_person = [item for item in meeting_status if item[1] == 1]
+        for item,new_roomsize in zip(in_person,rooms):
+            ratio = 1
+            old_roomsize = item[0]
+            if new_roomsize > 1.5 * old_roomsize and new_roomsize >= 20:
+                if old_roomsize < 10:
+                    old_roomsize = 10
+                ratio = old_roomsize / new_roomsize
+                if ratio > 1 or not self.social_distancing:
+                    ratio = 1
+                self.class_data[item[2]]['space_upgrade_factor'] = ratio
+                #print(ratio,old_roomsize,new_roomsize)
+            sum[2] += ratio
+            size[2] += item[0] * ratio
+            pairs[2] += item[0] * (item[0]-1) * ratio
         print('+++++ SD_WEIGH: %6i %8i %10i' % (int(sum[2]),int(size[2]),int(pairs[2])))
         if size[1] > 0:
             self.crowd_reduction_factor = pairs[2]/pairs[1]
             self.activity_reduction_factor = size[1]/size[0]
             print('+++++ Activity Reduction: %6.4f  Crowd Reduction: %6.4f' % (self.activity_reduction_factor,self.crowd_reduction_factor))
+        # Weekday activity index: day -> {person : in-person meetings that day}
+        self.weekday_activity = {day : {} for day in range(7)}
         for ptype in [self.student_data,self.instructor_data]:
             for person in ptype:
                 ptype[person]['physical_days'] = []
@@ -746,6 +859,9 @@ class University(object):
                         key = 'physical_days'
                     for day in self.class_data[classid]['days']:
                         ptype[person][key].append(day)
+                for day in ptype[person]['physical_days']:
+                    activity = self.weekday_activity[day]
+                    activity[person] = activity.get(person,0) + 1
         if not self.social_distancing:
             self.crowd_reduction_factor = 1
 
@@ -782,10 +898,14 @@ class University(object):
             classdata = self.class_data[itemid]
             if 'students' in classdata and len(classdata['students']) > 0 and len(classdata['students']) < self.online_transition:
                 daylist = classdata['days']
+                first = None
                 for day in daylist:
-                    context = self.compoundcontact.new_context(day,'academic')
+                    context = self.compoundcontact.new_context(day,'academic',first)
                     context.rate_factor = universal.in_class_base_rate * rate_adjustment * classdata['space_upgrade_factor']
                     context.social_distance_enabled = self.social_distancing
+                    if first is not None:
+                        continue # Later meeting days share the first day's members
+                    first = context
                     context.add_transmitters(classdata['students'])
                     context.add_receivers(classdata['students'])
                     found_instructor = False
@@ -805,12 +925,15 @@ class University(object):
         for itemid in self.department_data:
             deptdata = self.department_data[itemid]['instructors']
             if len(deptdata) > 1:
+                first = None
                 for day in self.department_data[itemid]['days']:
-                    context = self.compoundcontact.new_context(day,'departmental')
+                    context = self.compoundcontact.new_context(day,'departmental',first)
                     context.rate_factor = universal.in_dept_base_rate * rate_adjustment
                     context.social_distance_enabled = self.social_distancing
-                    context.add_transmitters(deptdata)
-                    context.add_receivers(deptdata)
+                    if first is None:
+                        first = context
+                        context.add_transmitters(deptdata)
+                        context.add_receivers(deptdata)
 
     def register_friendship_contacts(self,*rest,daily_contacts):
         context = self.compoundcontact.new_sparse()
@@ -850,45 +973,40 @@ class University(object):
         for deptid in self.department_data:
             if 'around_today' in self.department_data[deptid]:
                 for day in self.department_data[deptid]['around_today']:
-                    if len(self.department_data[deptid]['around_today'][day]) > 1:
+                    if sum(self.department_data[deptid]['around_today'][day].values()) > 1:
                         context = self.compoundcontact.new_context(day,'environmental')
                         context.social_distance_enabled = self.social_distancing
                         context.traceable = False
                         context.rate_factor = universal.in_dept_broad_base_rate * rate_adjustment * self.crowd_reduction_factor
-                        context.add_transmitters(self.department_data[deptid]['around_today'][day])
-                        context.add_receivers(self.department_data[deptid]['around_today'][day])
+                        context.add_members(self.department_data[deptid]['around_today'][day])
 
     def register_broad_contacts(self,*rest,daily_contacts,social_contacts):
-        allpeople = list(range(universal.students+universal.instructors))
         self.compoundcontact.target += 0.5 * (daily_contacts + social_contacts)
+        first_social = None
         for day in range(7):
             if day <= 4:
                 context = self.compoundcontact.new_context(day,'broad')
                 context.social_distance_enabled = self.social_distancing
                 context.traceable = False
-                active_today = []
-                for ptype in [self.student_data,self.instructor_data]:
-                    for person in ptype:
-                        for outday in ptype[person]['physical_days']:
-                            if day == outday:
-                                active_today.append(person)
-                context.rate_factor = daily_contacts / (2.0 * len(active_today))
+                active_today = self.weekday_activity[day]
+                activities = sum(active_today.values())
+                context.rate_factor = daily_contacts / (2.0 * activities)
                 context.rate_factor *= 1 / 2.16 * 1.05 # 2.16 expected activities per weekday for students; halfish that many for instructors
                 context.rate_factor *= 7/5 # Since they only happen on weekdays
                 context.rate_factor *= self.crowd_reduction_factor
-                context.add_transmitters(active_today)
-                context.add_receivers(active_today)
-                print('+++++ Active on Day',day,':',len(active_today))
+                context.add_members(active_today)
+                print('+++++ Active on Day',day,':',activities)
             if social_contacts > 0:
-                context = self.compoundcontact.new_context(day,'broad social')
+                context = self.compoundcontact.new_context(day,'broad social',first_social)
                 context.social_distance_enabled = False
                 context.traceable = True
                 context.rate_factor = social_contacts / 2 / (universal.students+universal.instructors - 1)
                 if day > 4:
                     context.rate_factor *= 2
                 context.rate_factor *= 7/9 # Since they're double on weekends
-                context.add_transmitters(allpeople)
-                context.add_receivers(allpeople)
+                if first_social is None:
+                    first_social = context
+                    context.add_members(list(range(universal.students+universal.instructors)))
 
     def register_residential_contacts(self,*rest,residential_neighbors):
         context = self.compoundcontact.new_permanent()